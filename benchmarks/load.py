@@ -0,0 +1,244 @@
+# Load driver for a running server filled by benchmarks.schema and benchmarks.api_keys:
+#   python -m benchmarks.load --url http://127.0.0.1:8080 --users 10 --meters 200 --concurrency 8 --duration 60 \
+#       --pid $(pgrep -f "server.py") --json results.json
+# Runs every endpoint and /download handler from concurrent clients and reports per scenario throughput,
+# p50/p95/p99 latency and bytes per second, plus the peak RSS of the server process when --pid is given
+import argparse
+import asyncio
+import datetime
+import itertools
+import json
+import random
+import time
+import urllib.parse
+
+import aiohttp
+
+from benchmarks import api_keys, schema
+
+
+class Client:
+    def __init__(self, session: aiohttp.ClientSession, url, number, args):
+        self.session = session
+        self.url = url.rstrip('/')
+        self.name, self.key, self.remote_name = api_keys.credentials(args.users, args.seed)[number - 1]
+        self.headers = {'username': self.name, 'api-key': self.key}
+        self.meters = [schema.meter_name(meter) for meter in range(number, args.meters + 1, args.users)]
+        self.args = args
+
+    def date_range(self, generator):
+        first = generator.randrange(max(self.args.days - self.args.range_days, 0) + 1)
+        date_from = schema.FIRST_DAY + datetime.timedelta(days=first)
+        date_to = date_from + datetime.timedelta(days=self.args.range_days - 1)
+        return str(date_from), str(date_to)
+
+    async def post(self, path, data, headers=None):
+        async with self.session.post(self.url + path, data=data, headers=headers) as response:
+            body = await response.read()
+            if response.status != 200:
+                raise RuntimeError(f'{path}: HTTP {response.status}')
+            return body
+
+    async def post_json(self, path, data, headers=None):
+        body = json.loads(await self.post(path, data, headers))
+        if 'error' in body:
+            raise RuntimeError(f"{path}: {body['error']}")
+        return body
+
+    async def download(self, token_path, data, headers=None):
+        token = (await self.post_json(token_path, data, headers))['token']
+        params = {'token': urllib.parse.unquote(token)}
+        async with self.session.get(self.url + '/download', params=params) as response:
+            size = 0
+            async for chunk in response.content.iter_chunked(64 * 1024):
+                size += len(chunk)
+            if response.status != 200 or response.content_type == 'application/json':
+                raise RuntimeError(f'/download ({token_path}): HTTP {response.status} {response.content_type}')
+            return size
+
+    async def readings(self, generator):
+        date_from, date_to = self.date_range(generator)
+        return await self.download('/readings/csv_token', {
+            'import_reads': '1', 'export_reads': '1', 'fromdate': date_from, 'todate': date_to,
+        }, self.headers)
+
+    async def emc1sp_csv(self, generator):
+        date_from, date_to = self.date_range(generator)
+        return await self.download('/emc1sp/csv_token', {'fromdate': date_from, 'todate': date_to}, self.headers)
+
+    async def emc1sp_json(self, generator):
+        date_from, date_to = self.date_range(generator)
+        return len(await self.post('/emc1sp/json', {'fromdate': date_from, 'todate': date_to}, self.headers))
+
+    async def total_readings(self, generator):
+        date_from, _ = self.date_range(generator)
+        data = [('date', date_from), *(('meters', meter) for meter in self.meters)]
+        return len(await self.post('/total_readings/json', data, self.headers))
+
+    async def wifi(self, generator):
+        date_from, date_to = self.date_range(generator)
+        return await self.download('/wifi/csv_token', [
+            ('date_from', date_from), ('date_to', f'{date_to} 23:59:59'), ('username', self.remote_name),
+            ('fields', 'serial'), ('fields', 'date'),
+        ])
+
+    async def regular(self, generator):
+        date_from, date_to = self.date_range(generator)
+        return await self.download('/regular/csv_token', [
+            ('date_from', date_from), ('date_to', date_to), ('username', self.remote_name),
+            *(('fields', field) for field in ('serial', 'date', 'import_total', 'import_daily', 'utilisation_daily')),
+            *(('fields', f'import{slot}') for slot in schema.SLOTS),
+        ])
+
+    async def spc(self, generator):
+        date_from, date_to = self.date_range(generator)
+        return await self.download('/spc/csv_token', [
+            ('date_from', date_from), ('date_to', date_to), ('username', self.remote_name),
+            *(('fields', field) for field in ('serial', 'date', 'domestic_load_daily', 'generation_daily')),
+            *(('fields', f'generation{slot}') for slot in schema.SLOTS),
+        ])
+
+
+SCENARIOS = ('readings', 'emc1sp_csv', 'emc1sp_json', 'total_readings', 'wifi', 'regular', 'spc')
+
+
+class Results:
+    def __init__(self):
+        self.latencies = {}  # scenario -> seconds of successful requests
+        self.bytes = {}
+        self.errors = {}
+
+    def add(self, scenario, seconds, size):
+        self.latencies.setdefault(scenario, []).append(seconds)
+        self.bytes[scenario] = self.bytes.get(scenario, 0) + size
+
+    def error(self, scenario, message):
+        self.errors.setdefault(scenario, {})
+        self.errors[scenario][message] = self.errors[scenario].get(message, 0) + 1
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def memory_kib(pid, field):
+    # VmRSS (current) or VmHWM (peak) of a local process
+    try:
+        with open(f'/proc/{pid}/status') as status:
+            for line in status:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+
+async def sample_rss(pid, peak):
+    while True:
+        rss = memory_kib(pid, 'VmRSS')
+        if rss is not None:
+            peak[0] = max(peak[0], rss)
+        await asyncio.sleep(0.2)
+
+
+async def worker(session, args, number, scenarios, deadline, results):
+    generator = random.Random(args.seed * 1000 + number)
+    clients = [Client(session, args.url, user, args) for user in range(1, args.users + 1)]
+    for count in itertools.count():
+        if time.monotonic() >= deadline or (args.requests and count >= args.requests):
+            return
+        scenario = scenarios[(number + count) % len(scenarios)]
+        client = generator.choice(clients)
+        started = time.monotonic()
+        try:
+            size = await getattr(client, scenario)(generator)
+        except (aiohttp.ClientError, asyncio.TimeoutError, RuntimeError) as exception:
+            results.error(scenario, str(exception) or type(exception).__name__)
+        else:
+            results.add(scenario, time.monotonic() - started, size)
+
+
+def report(results: Results, elapsed, peak_rss_kib, hwm_kib):
+    summary = {'elapsed_seconds': elapsed, 'peak_rss_kib': peak_rss_kib, 'server_hwm_kib': hwm_kib, 'scenarios': {}}
+    print(f"{'scenario':<16}{'requests':>9}{'errors':>8}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'MB/s':>9}")
+    for scenario in SCENARIOS:
+        if scenario not in results.latencies and scenario not in results.errors:
+            continue
+        latencies = sorted(results.latencies.get(scenario, []))
+        errors = sum(results.errors.get(scenario, {}).values())
+        row = {
+            'requests': len(latencies),
+            'errors': errors,
+            'requests_per_second': len(latencies) / elapsed,
+            'p50_ms': None if not latencies else percentile(latencies, 0.50) * 1000,
+            'p95_ms': None if not latencies else percentile(latencies, 0.95) * 1000,
+            'p99_ms': None if not latencies else percentile(latencies, 0.99) * 1000,
+            'bytes_per_second': results.bytes.get(scenario, 0) / elapsed,
+            'error_messages': results.errors.get(scenario, {}),
+        }
+        summary['scenarios'][scenario] = row
+        milliseconds = [f"{row[name]:>9.1f}" if row[name] is not None else f"{'-':>9}" for name in ('p50_ms', 'p95_ms', 'p99_ms')]
+        print(f"{scenario:<16}{row['requests']:>9}{errors:>8}{row['requests_per_second']:>9.2f}"
+              f"{''.join(milliseconds)}{row['bytes_per_second'] / 1e6:>9.2f}")
+
+    total_requests = sum(len(latencies) for latencies in results.latencies.values())
+    total_bytes = sum(results.bytes.values())
+    print(f'total: {total_requests} requests in {elapsed:.1f}s, {total_requests / elapsed:.2f} req/s, '
+          f'{total_bytes / elapsed / 1e6:.2f} MB/s')
+    if peak_rss_kib:
+        print(f'server peak RSS: {peak_rss_kib / 1024:.1f} MiB sampled, {(hwm_kib or 0) / 1024:.1f} MiB high water mark')
+    for scenario, messages in results.errors.items():
+        for message, count in messages.items():
+            print(f'  {scenario}: {count} x {message}')
+    return summary
+
+
+async def run(args):
+    scenarios = args.scenarios or list(SCENARIOS)
+    results = Results()
+    peak = [0]
+    sampler = asyncio.ensure_future(sample_rss(args.pid, peak)) if args.pid else None
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    async with aiohttp.ClientSession(timeout=timeout, connector=connector, auto_decompress=True) as session:
+        started = time.monotonic()
+        deadline = started + args.duration if args.duration else float('inf')
+        await asyncio.gather(*[
+            worker(session, args, number, scenarios, deadline, results) for number in range(args.concurrency)
+        ])
+        elapsed = time.monotonic() - started
+    if sampler is not None:
+        sampler.cancel()
+    hwm = memory_kib(args.pid, 'VmHWM') if args.pid else None
+    return report(results, elapsed, peak[0] or None, hwm)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark a running server')
+    parser.add_argument('--url', default='http://127.0.0.1:8080')
+    parser.add_argument('--users', type=int, default=10, help='as passed to benchmarks.schema and benchmarks.api_keys')
+    parser.add_argument('--meters', type=int, default=200, help='as passed to benchmarks.schema')
+    parser.add_argument('--days', type=int, default=365, help='as passed to benchmarks.schema')
+    parser.add_argument('--seed', type=int, default=1, help='as passed to benchmarks.api_keys')
+    parser.add_argument('--range-days', type=int, default=30, help='days per export request')
+    parser.add_argument('--concurrency', type=int, default=8, help='clients sending requests at once')
+    parser.add_argument('--duration', type=float, default=60, help='seconds, 0 runs until --requests are done')
+    parser.add_argument('--requests', type=int, default=0, help='requests per client, 0 = until --duration')
+    parser.add_argument('--timeout', type=float, default=600, help='seconds per request')
+    parser.add_argument('--scenarios', nargs='*', choices=SCENARIOS, help='all of them by default')
+    parser.add_argument('--pid', type=int, help='server process to measure the RSS of (Linux)')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+    if not args.duration and not args.requests:
+        parser.error('either --duration or --requests is needed')
+
+    summary = asyncio.get_event_loop().run_until_complete(run(args))
+    if args.json:
+        summary['arguments'] = vars(args)
+        with open(args.json, 'w') as results_file:
+            json.dump(summary, results_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,384 @@
+# Index advisor for the openmetrics tables the API reads:
+#   python indexes.py --config config             report missing, invalid, unused and redundant indexes
+#   python indexes.py --config config --verify    also EXPLAIN the API's query shapes and check they use them
+#   python indexes.py --config config --create    create the missing indexes (CREATE INDEX CONCURRENTLY)
+# The DSN comes from OPENMETRICS_DSN of the config module (or the environment), or from --dsn.
+# Exits with 1 when an index is missing or invalid, or a verified plan does not use its index.
+import argparse
+import collections
+import datetime
+import importlib
+import json
+import os
+import sys
+import time
+
+import psycopg2
+
+from server.endpoints import emc1sp, readings, regular_export, spc_export, total_readings, wifi_export
+from server.utility import config, meter_access, rollup
+
+Index = collections.namedtuple('Index', ('name', 'table', 'columns', 'include', 'used_by'))
+
+# What the API's queries filter, join and sort on. Any valid index starting with the same columns
+# (and holding the included ones) does, whatever its name.
+INDEXES = (
+    Index('readings_reading_meter_id_date', 'readings_reading', ('meter_id', 'date'), (),
+          '/readings, /emc1sp (pages too), /total_readings, regular and spc exports, rollups'),
+    Index('readings_spcreading_meter_id_date', 'readings_spcreading', ('meter_id', 'date'), (),
+          'spc exports, joined on meter and date'),
+    Index('readings_spcreading_name', 'readings_spcreading', ('name',), (),
+          '/emc1sp and rollups, joined on name'),
+    Index('readings_gasreading_name', 'readings_gasreading', ('name',), (),
+          '/emc1sp and rollups, joined on name'),
+    Index('readings_wifireading_meter_id_datetime', 'readings_wifireading', ('meter_id', 'datetime'), (),
+          'wifi exports of a user'),
+    Index('readings_wifireading_datetime', 'readings_wifireading', ('datetime',), ('meter_id',),
+          'superuser wifi exports (every meter, sorted by datetime), index only'),
+    Index('users_profile_meters_profile_id', 'users_profile_meters', ('profile_id',), (),
+          'meters of a user'),
+    Index('auth_user_username', 'auth_user', ('username',), (),
+          'meters of a user'),
+)
+
+TABLES = sorted({index.table for index in INDEXES} | {'meters_meter'})
+
+Shape = collections.namedtuple('Shape', ('name', 'query', 'parameters', 'indexes'))
+
+
+def readings_parameters(sample):
+    return {
+        'meter_ids': sample['meter_ids'],
+        'fromdate': sample['date_from'].isoformat(),
+        'todate': sample['date_to'].isoformat(),
+    }
+
+
+def emc1sp_page_parameters(sample):
+    # the second page: past the first day of the first meter
+    after = (sample['meter_ids'][0] if sample['meter_ids'] else 0, sample['date_from'].isoformat(), 0, 0, 0)
+    return {
+        **readings_parameters(sample),
+        'after_key': after[:2],
+        'after': after,
+        'limit': emc1sp.EMC1SP_PAGE_SIZE + 1,
+    }
+
+
+def filter_parameters(meter_type=None, all_users=False, sharded=False):
+    # parameters of meters_filter (regular and spc exports, with meter_type) or of the wifi query
+    def parameters(sample):
+        values = {
+            'meter_ids': [] if all_users else sample['meter_ids'],
+            'all_users': all_users,
+            'empty_slugs': True,
+            'slugs': ('',),
+            'date_from': sample['date_from'].isoformat(),
+            'date_to': sample['date_to'].isoformat(),
+        }
+        if meter_type is not None:
+            values['type'] = meter_type
+        if sharded:
+            # the first part of a range split in two
+            values['shard_from'] = sample['date_from']
+            values['shard_to'] = sample['date_from'] + (sample['date_to'] - sample['date_from']) / 2
+        return values
+
+    return parameters
+
+
+def rollup_parameters(sample):
+    return {
+        'period': 'month',
+        'meter_ids': sample['meter_ids'],
+        'from_date': sample['date_from'].isoformat(),
+        'to_date': sample['date_to'].isoformat(),
+        'since': None,
+    }
+
+
+__READINGS_COLUMNS = ('m.name', 'm.mpan', 'm.location', 'r.date', 'r.import_total_wh', 'r.import_total')
+__WIFI_COLUMNS = ('meter.name', 'wifi_reading.datetime')
+# readings joined with their spc and gas readings by name
+__EMC1SP_INDEXES = ('readings_reading_meter_id_date', 'readings_spcreading_name', 'readings_gasreading_name')
+__regular_export = regular_export.RegularExport(None)
+__spc_export = spc_export.SPCExport(None)
+
+# The API's statements, built by the endpoints' own query functions, with the indexes each one should use
+SHAPES = (
+    Shape('/readings export', readings.select_query(__READINGS_COLUMNS),
+          readings_parameters, ('readings_reading_meter_id_date',)),
+    Shape('/readings export in parts', readings.select_query(__READINGS_COLUMNS, sharded=True),
+          readings_parameters, ('readings_reading_meter_id_date',)),
+    Shape('/total_readings', total_readings.select_query,
+          lambda sample: {'meter_ids': sample['meter_ids'], 'date': sample['date_to'].isoformat()},
+          ('readings_reading_meter_id_date',)),
+    Shape('/emc1sp', emc1sp.select_query(),
+          readings_parameters, __EMC1SP_INDEXES),
+    Shape('/emc1sp page', emc1sp.select_query(paged=True, after=True),
+          emc1sp_page_parameters, __EMC1SP_INDEXES),
+    Shape('/readings/rollup', rollup.live_query,
+          rollup_parameters, __EMC1SP_INDEXES),
+    Shape('regular export', __regular_export.select_query(['name', 'date', 'import_total']),
+          filter_parameters(__regular_export.meter_type()), ('readings_reading_meter_id_date',)),
+    Shape('spc export', __spc_export.select_query(['name', 'date', 'domestic_load_total', 'grid_energy_total']),
+          filter_parameters(__spc_export.meter_type()),
+          ('readings_reading_meter_id_date', 'readings_spcreading_meter_id_date')),
+    Shape('wifi export of a user', wifi_export.select_query(__WIFI_COLUMNS),
+          filter_parameters(), ('readings_wifireading_meter_id_datetime',)),
+    Shape('wifi export of a user in parts', wifi_export.select_query(__WIFI_COLUMNS, sharded=True),
+          filter_parameters(sharded=True), ('readings_wifireading_meter_id_datetime',)),
+    Shape('superuser wifi export', wifi_export.select_query(__WIFI_COLUMNS),
+          filter_parameters(all_users=True), ('readings_wifireading_datetime',)),
+    Shape('meter access', meter_access.meter_access_query,
+          lambda sample: {'username': sample['username']}, ('auth_user_username', 'users_profile_meters_profile_id')),
+)
+
+
+Existing = collections.namedtuple('Existing', (
+    'name', 'table', 'columns', 'key_count', 'valid', 'unique', 'partial', 'scans', 'size'
+))
+
+
+def existing_indexes(cursor):
+    # btree indexes of the API's tables, expression columns read as None
+    cursor.execute("""
+        SELECT index_class.relname, table_class.relname,
+            array(
+                SELECT attribute.attname
+                FROM unnest(pg_index.indkey) WITH ORDINALITY AS key(attnum, position)
+                LEFT JOIN pg_attribute AS attribute
+                    ON attribute.attrelid = pg_index.indrelid AND attribute.attnum = key.attnum
+                ORDER BY key.position
+            ),
+            pg_index.indnkeyatts, pg_index.indisvalid, pg_index.indisunique,
+            pg_index.indpred IS NOT NULL OR pg_index.indexprs IS NOT NULL,
+            coalesce(stats.idx_scan, 0), pg_relation_size(pg_index.indexrelid)
+        FROM pg_index
+        JOIN pg_class AS index_class ON index_class.oid = pg_index.indexrelid
+        JOIN pg_class AS table_class ON table_class.oid = pg_index.indrelid
+        JOIN pg_am ON pg_am.oid = index_class.relam
+        LEFT JOIN pg_stat_user_indexes AS stats ON stats.indexrelid = pg_index.indexrelid
+        WHERE table_class.relnamespace = current_schema()::regnamespace
+        AND table_class.relname = ANY(%(tables)s) AND pg_am.amname = 'btree'
+        ORDER BY table_class.relname, index_class.relname;
+    """, {'tables': TABLES})
+    return [Existing(*row) for row in cursor.fetchall()]
+
+
+def covers(existing: Existing, index: Index):
+    # existing serves index: same leading key columns, included columns anywhere in it
+    key_columns = existing.columns[:existing.key_count]
+    return (
+        existing.table == index.table and existing.valid and not existing.partial
+        and tuple(key_columns[:len(index.columns)]) == index.columns
+        and all(column in existing.columns for column in index.include)
+    )
+
+
+def coverage_of(existing):
+    # (index, existing index serving it or None) of every entry of INDEXES
+    return [(index, next((other for other in existing if covers(other, index)), None)) for index in INDEXES]
+
+
+def create_statement(index: Index):
+    include = f" INCLUDE ({', '.join(index.include)})" if index.include else ''
+    return f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {index.name} ON {index.table} ({', '.join(index.columns)}){include};"
+
+
+def size_text(size):
+    for unit in ('B', 'kB', 'MB', 'GB'):
+        if size < 1024:
+            return f'{size:.0f} {unit}'
+        size /= 1024
+    return f'{size:.0f} TB'
+
+
+def advise(cursor, existing, coverage):
+    # the needed indexes, then the unused and the redundant ones
+    print('Indexes the API needs:')
+    for index, other in coverage:
+        columns = f"{index.table} ({', '.join(index.columns)})"
+        if index.include:
+            columns += f" INCLUDE ({', '.join(index.include)})"
+        if other is not None:
+            print(f'  ok       {columns} as {other.name} -- {index.used_by}')
+            continue
+        invalid = next((other for other in existing if other.name == index.name and not other.valid), None)
+        print(f"  {'invalid' if invalid else 'missing':8} {columns} -- {index.used_by}")
+        print(f'           {create_statement(index)}')
+
+    cursor.execute('SELECT stats_reset FROM pg_stat_database WHERE datname = current_database();')
+    stats_reset, = cursor.fetchone()
+    needed = {other.name for _, other in coverage if other is not None}
+    unused = [other for other in existing if not other.scans and not other.unique and other.name not in needed]
+    since = 'the statistics were reset at ' + str(stats_reset) if stats_reset else 'the statistics were reset'
+    print(f'Unused indexes (no scan on this server since {since}):')
+    for other in unused:
+        print(f"  {other.name} on {other.table} ({', '.join(map(str, other.columns))}), {size_text(other.size)}")
+    if not unused:
+        print('  none')
+
+    print('Redundant indexes (their key columns start another index):')
+    redundant = False
+    for other in existing:
+        keys = other.columns[:other.key_count]
+        if other.unique or other.partial or None in keys:
+            continue
+        for wider in existing:
+            wider_keys = wider.columns[:wider.key_count]
+            if wider is not other and wider.table == other.table and wider.valid and not wider.partial \
+                    and len(wider_keys) > len(keys) and wider_keys[:len(keys)] == keys:
+                print(f"  {other.name} ({', '.join(keys)}), {size_text(other.size)}: {wider.name} "
+                      f"({', '.join(map(str, wider_keys))}) serves the same lookups")
+                redundant = True
+                break
+    if not redundant:
+        print('  none')
+
+
+def create(connection, coverage, existing):
+    # CONCURRENTLY can not run in a transaction; an invalid leftover of a failed build is dropped first
+    connection.autocommit = True
+    with connection.cursor() as cursor:
+        for index, other in coverage:
+            if other is not None:
+                continue
+            if any(leftover.name == index.name and not leftover.valid for leftover in existing):
+                print(f'DROP INDEX CONCURRENTLY {index.name};')
+                cursor.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {index.name};')
+            statement = create_statement(index)
+            print(statement, end=' ', flush=True)
+            started = time.monotonic()
+            cursor.execute(statement)
+            cursor.execute(f'ANALYZE {index.table};')
+            print(f'({time.monotonic() - started:.1f} s)')
+
+
+def sample_parameters(cursor, date_to, days):
+    # the user with the most meters and the last days up to date_to
+    cursor.execute("""
+        SELECT auth_user.username, array_agg(profile_meters.meter_id ORDER BY profile_meters.meter_id)
+        FROM users_profile_meters AS profile_meters
+        JOIN auth_user ON auth_user.id = profile_meters.profile_id
+        GROUP BY auth_user.username
+        ORDER BY count(*) DESC, auth_user.username
+        LIMIT 1;
+    """)
+    row = cursor.fetchone()
+    username, meter_ids = row if row else ('', [])
+    return {
+        'username': username,
+        'meter_ids': meter_ids,
+        'date_from': date_to - datetime.timedelta(days=days - 1),
+        'date_to': date_to,
+    }
+
+
+def plan_indexes(plan):
+    # names of the indexes a JSON plan (node) reads
+    names = set()
+    if 'Index Name' in plan:
+        names.add(plan['Index Name'])
+    for child in plan.get('Plans', ()):
+        names |= plan_indexes(child)
+    return names
+
+
+def explain(cursor, query, parameters, seqscan=True):
+    cursor.execute('BEGIN;')
+    try:
+        if not seqscan:
+            cursor.execute('SET LOCAL enable_seqscan = off;')
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + query, parameters)
+        plan, = cursor.fetchone()
+    finally:
+        cursor.execute('ROLLBACK;')
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan_indexes(plan[0]['Plan'])
+
+
+def verify(cursor, coverage, parameters):
+    # every shape should read the indexes serving its Index entries. When it does not, the plan is made again
+    # without sequential scans, to tell a planner preference (small tables, wide ranges, another of the
+    # indexes of the same table) from an index the statement can not use.
+    serving = {index.name: other.name for index, other in coverage if other is not None}
+    tables = {index.name: index.table for index in INDEXES}
+    print(f"Plans (user {parameters['username'] or '-'}, {len(parameters['meter_ids'])} meters, "
+          f"{parameters['date_from']} .. {parameters['date_to']}):")
+    failed = False
+    for shape in SHAPES:
+        shape_parameters = shape.parameters(parameters)
+        used = explain(cursor, shape.query, shape_parameters)
+        missing = [name for name in shape.indexes if serving.get(name) not in used]
+        if not missing:
+            print(f"  ok       {shape.name}: {', '.join(sorted(used))}")
+            continue
+        absent = [name for name in missing if name not in serving]
+        if absent:
+            failed = True
+            print(f"  missing  {shape.name}: needs {', '.join(absent)}")
+            continue
+        forced = used | explain(cursor, shape.query, shape_parameters, seqscan=False)
+        notes = []
+        for name in missing:
+            alternatives = sorted(
+                serving[other] for other in serving
+                if other != name and tables[other] == tables[name] and serving[other] in forced
+            )
+            if serving[name] in forced:
+                notes.append(f'a sequential scan is preferred over {serving[name]}')
+            elif alternatives:
+                notes.append(f"{', '.join(alternatives)} is preferred over {serving[name]}")
+            else:
+                failed = True
+                print(f"  unusable {shape.name}: {serving[name]} can not serve the statement")
+                break
+        else:
+            print(f"  prefers  {shape.name}: {'; '.join(notes)} for these meters and dates")
+    return not failed
+
+
+def openmetrics_dsn(args):
+    if args.dsn is not None:
+        return args.dsn
+    settings = importlib.import_module(args.config) if args.config is not None else os.environ
+    return config({'config': settings}, 'OPENMETRICS_DSN')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the openmetrics indexes against the queries of the API')
+    parser.add_argument('--config', help='config module (like server.py, without .py)')
+    parser.add_argument('--dsn', help='openmetrics database, instead of OPENMETRICS_DSN')
+    parser.add_argument('--create', action='store_true', help='create the missing indexes, CONCURRENTLY')
+    parser.add_argument('--verify', action='store_true', help='check the plans of the API queries use the indexes')
+    parser.add_argument('--date-to', type=datetime.date.fromisoformat, default=datetime.date.today(),
+                        help='last day of the verified plans (default: today)')
+    parser.add_argument('--days', type=int, default=7, help='days of the verified plans')
+    args = parser.parse_args()
+
+    connection = psycopg2.connect(openmetrics_dsn(args))
+    try:
+        with connection.cursor() as cursor:
+            existing = existing_indexes(cursor)
+            coverage = coverage_of(existing)
+            advise(cursor, existing, coverage)
+        connection.rollback()
+        if args.create and any(other is None for _, other in coverage):
+            create(connection, coverage, existing)
+            with connection.cursor() as cursor:
+                existing = existing_indexes(cursor)
+            coverage = coverage_of(existing)
+        ok = all(other is not None for _, other in coverage)
+        if args.verify:
+            connection.autocommit = True
+            with connection.cursor() as cursor:
+                ok = verify(cursor, coverage, sample_parameters(cursor, args.date_to, args.days)) and ok
+    finally:
+        connection.close()
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,15 +2,25 @@ import asyncio
 
 from aiohttp import web
 
-from server.utility import database
+from server.utility import admission, database, encoding, export_cache, jobs, meter_access, metrics, request_log, rollup, singleflight, user_keys
 from server import endpoints
 
 
 async def configure_app(config):
-    app = web.Application()
+    app = web.Application(middlewares=[metrics.metrics_middleware])
     app['config'] = config
     app.cleanup_ctx.append(database.openmetrics_ctx)
     app.cleanup_ctx.append(database.local_storage_ctx)
+    app.cleanup_ctx.append(database.openmetrics_copy_ctx)
+    app.cleanup_ctx.append(user_keys.api_key_cache_ctx)
+    app.cleanup_ctx.append(meter_access.meter_access_ctx)
+    app.cleanup_ctx.append(admission.admission_ctx)
+    app.cleanup_ctx.append(request_log.request_log_ctx)
+    app.cleanup_ctx.append(export_cache.export_cache_ctx)
+    app.cleanup_ctx.append(singleflight.singleflight_ctx)
+    app.cleanup_ctx.append(encoding.encoder_ctx)
+    app.cleanup_ctx.append(jobs.jobs_ctx)
+    app.cleanup_ctx.append(rollup.rollup_ctx)
     endpoints.add_to(app)
     return app
 
@@ -22,3 +22,12 @@ def add_to(app: web.Application):
 
     from .total_readings import endpoints as total_readings
     app.add_routes(total_readings)
+
+    from .status import endpoints as status
+    app.add_routes(status)
+
+    from .metrics import endpoints as metrics
+    app.add_routes(metrics)
+
+    from .jobs import endpoints as jobs
+    app.add_routes(jobs)
@@ -1,5 +1,5 @@
 from aiohttp import web
-from server.utility import tokens, config
+from server.utility import tokens, config, export_cache, admission
 
 endpoints = web.RouteTableDef()
 
@@ -14,7 +14,14 @@ async def download(request):
     try:
         secret_key = config(request.app, 'SECRET_KEY')
         target_function, request_args = tokens.parse_request_token(secret_key, request.query['token'])
-        return await target_function(request, request_args)
+        request['token_handler'] = tokens.handler_name(target_function)
+        # identical exports running at the same time are produced once (see singleflight)
+        request['export_key'] = export_cache.cache_key(request['token_handler'], request_args)
+        # exports are heavy, limited per requesting api username (or exported user)
+        key = request_args.get('usr') or request_args.get('username') or '_SUPERUSER'
+        return await admission.admitted(
+            request, 'heavy', key, lambda: target_function(request, request_args)
+        )
     except (ValueError, KeyError):
         return web.json_response({
             'error': "Invalid token"
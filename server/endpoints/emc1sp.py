@@ -1,15 +1,20 @@
-import csv
 import datetime
-import io
 
 from aiohttp import web
-from server.utility import user_keys, tokens, database, config
+from server.utility import user_keys, tokens, database, config, streaming, export_cache, meter_access, admission
 
 endpoints = web.RouteTableDef()
 
 
-async def emc1sp_query_iter(openmetrics, remote_name, from_date, to_date):
-    select_query = """-- noinspection SqlResolveForFile
+# Rows per page of emc1sp/json when paginated, and the most a client can ask for
+EMC1SP_PAGE_SIZE = 500
+EMC1SP_MAX_PAGE_SIZE = 5000
+
+
+# Keyset of a page: (meter id, date) is not unique, the row ids break ties
+PAGE_COLUMNS = ('r.meter_id', 'r.date', 'r.id', 'g.id', 'spc.id')
+
+emc1sp_query = """-- noinspection SqlResolveForFile
         SELECT m.name, m.mpan, m.location, r.date,
             r.export_total_wh, -- Domestic Load kWh
             spc.grid_energy_wh, -- Grid Energy Utilised kWh
@@ -18,50 +23,86 @@ async def emc1sp_query_iter(openmetrics, remote_name, from_date, to_date):
             spc.generation_wh, -- Generation kWh
             spc.charge_wh, -- Battery Charge kWh
             g.import_total_wh -- Gas Total m3
-
+            /*<page_columns>*/
         FROM readings_reading AS r
         INNER JOIN readings_gasreading AS g ON (r.name=g.name)
         INNER JOIN readings_spcreading AS spc ON (r.name=spc.name)
         INNER JOIN meters_meter AS m ON (m.id=r.meter_id)
-        WHERE r.meter_id IN
-        (SELECT meter_id FROM users_profile_meters WHERE profile_id =
-        (SELECT id FROM auth_user WHERE username = %(username)s)) --username taken from remote_name of APIKeys
-        AND r.date >= %(fromdate)s AND r.date <= %(todate)s; -- from and to dates from body of request
+        WHERE r.meter_id = ANY(%(meter_ids)s) -- meters of the remote_name of APIKeys
+        AND r.date >= %(fromdate)s AND r.date <= %(todate)s -- from and to dates from body of request
+        /*<page>*/;
     """
 
+
+def select_query(paged=False, after=False):
+    # paged: ordered by PAGE_COLUMNS, %(limit)s rows, after: past the %(after)s position (values of PAGE_COLUMNS)
+    # starting at %(after_key)s, its meter id and date
+    if not paged:
+        return emc1sp_query.replace('/*<page_columns>*/', '').replace('/*<page>*/', '')
+    page = f'ORDER BY {", ".join(PAGE_COLUMNS)} LIMIT %(limit)s'
+    if after:
+        # the (meter id, date) bound alone is what an index on readings_reading can seek to
+        page = f'AND (r.meter_id, r.date) >= %(after_key)s AND ({", ".join(PAGE_COLUMNS)}) > %(after)s ' + page
+    page_columns = ''.join(f', {column}' for column in PAGE_COLUMNS if column != 'r.date')
+    return emc1sp_query.replace('/*<page_columns>*/', page_columns).replace('/*<page>*/', page)
+
+
+async def emc1sp_rows(app, remote_name, from_date, to_date, after=None, limit=None):
+    # With a limit: rows ordered by PAGE_COLUMNS starting after the after position (values of PAGE_COLUMNS),
+    # each row ends with its PAGE_COLUMNS but the date
+    access = await meter_access.get(app, remote_name)
     parameters = {
         'fromdate': from_date,
         'todate': to_date,
-        'username': remote_name,
+        'meter_ids': access.meter_ids(),
     }
 
-    to_kwh_fields = (
-        'domestic_load_kwh',
-        'grid_energy_utilised_kwh',
-        'grid_export_kwh',
-        'solar_storage_utilised_kwh',
-        'generation_kwh',
-        'battery_charge_kwh',
-    )
+    if limit is not None:
+        # keyset pagination: seek to the position instead of skipping rows
+        if after is not None:
+            parameters['after_key'], parameters['after'] = tuple(after[:2]), tuple(after)
+            parameters['meter_ids'] = [meter_id for meter_id in parameters['meter_ids'] if meter_id >= after[0]]
+        parameters['limit'] = limit
 
-    query_fields = (
-        'name', 'reference', 'description', 'date',
-        *to_kwh_fields,
-        'gas_total_m3'
-    )
+    query = select_query(paged=limit is not None, after=after is not None)
+    rows = database.openmetrics_rows(app, query, parameters, server_side=limit is None)
+    try:
+        async for row in rows:
+            yield row
+    finally:
+        await rows.aclose()
+
+
+TO_KWH_FIELDS = (
+    'domestic_load_kwh',
+    'grid_energy_utilised_kwh',
+    'grid_export_kwh',
+    'solar_storage_utilised_kwh',
+    'generation_kwh',
+    'battery_charge_kwh',
+)
+
+QUERY_FIELDS = (
+    'name', 'reference', 'description', 'date',
+    *TO_KWH_FIELDS,
+    'gas_total_m3'
+)
+
+
+def emc1sp_item(selected_row):
+    item = dict(zip(QUERY_FIELDS, selected_row))
+
+    for wh_field in TO_KWH_FIELDS:
+        item[wh_field] /= 1000
 
-    async with openmetrics as conn:
-        async with conn.cursor() as cursor:
-            await cursor.execute(select_query, parameters)
-            async for selected_row in cursor:
-                item = dict(zip(query_fields, selected_row))
+    item['date'] = item['date'].strftime("%Y-%m-%d")
+    item['solar_generation_kwh'] = item['generation_kwh'] - item['battery_charge_kwh']
+    return item
 
-                for wh_field in to_kwh_fields:
-                    item[wh_field] /= 1000
 
-                item['date'] = item['date'].strftime("%Y-%m-%d")
-                item['solar_generation_kwh'] = item['generation_kwh'] - item['battery_charge_kwh']
-                yield item
+async def emc1sp_query_iter(app, remote_name, from_date, to_date):
+    async for selected_row in emc1sp_rows(app, remote_name, from_date, to_date):
+        yield emc1sp_item(selected_row)
 
 
 @tokens.register_token_handler('emc1sp/exp')
@@ -78,37 +119,31 @@ async def emc1sp_csv(request, request_args):
         'gas_total_m3',
     )
 
-    csv_response = io.StringIO()
-    writer = csv.DictWriter(csv_response, field_names)
-    writer.writeheader()
-
     from_date = request_args['fd']
     to_date = request_args['td']
     remote_name = await user_keys.get_remote_username(
-        local_db=database.local_storage(request.app),
+        request.app,
         username=request_args['usr'],
         api_key=request_args['key']
     )
 
-    async for response_row in emc1sp_query_iter(database.openmetrics(request.app), remote_name, from_date, to_date):
-        writer.writerow(response_row)
+    def response_row(selected_row):
+        item = emc1sp_item(selected_row)
+        return [item[field_name] for field_name in field_names]
 
     current_time = datetime.datetime.now().strftime('%Y%m%d%H%M')
-    filename = f"{request_args['usr']}_{current_time}_csvexport.csv"
+    filename_prefix = f"{request_args['usr']}_{current_time}"
 
-    response = web.StreamResponse()
-    response.headers['CONTENT-DISPOSITION'] = f'attachment; filename="{filename}"'
-    await response.prepare(request)
-    try:
-        csv_response.seek(0)
-        while True:
-            file_part = csv_response.read(4096*4096)
-            if len(file_part) <= 0:
-                break
-            await response.write(file_part.encode())
-    finally:
-        await response.write_eof()
-    return response
+    cache_args = {'fd': from_date, 'td': to_date, 'remote_name': remote_name}
+    access = await meter_access.get(request.app, remote_name)
+
+    return await streaming.send_export(
+        request, filename_prefix, 'csv', field_names, emc1sp_rows(request.app, remote_name, from_date, to_date),
+        cache=export_cache.entry(
+            request.app, tokens.handler_name(emc1sp_csv), cache_args, to_date, access.meter_ids()
+        ),
+        projection=response_row
+    )
 
 
 @endpoints.post("/emc1sp/csv_token")
@@ -138,11 +173,69 @@ async def emc1sp_csv_token(request):
     })
 
 
+async def emc1sp_page(request, body):
+    try:
+        limit = int(body.get('limit', config(request.app, 'EMC1SP_PAGE_SIZE', EMC1SP_PAGE_SIZE)))
+    except ValueError:
+        return web.json_response({
+            "error": "'limit' must be a number"
+        })
+    limit = min(max(limit, 1), int(config(request.app, 'EMC1SP_MAX_PAGE_SIZE', EMC1SP_MAX_PAGE_SIZE)))
+
+    secret_key = config(request.app, 'SECRET_KEY')
+    if 'cursor' in body:
+        try:
+            position = tokens.parse_cursor(secret_key, body['cursor'])
+        except ValueError:
+            position = None
+        if position is None or position.get('usr') != request.headers["username"] or 'r' not in position:
+            return web.json_response({
+                "error": "Invalid 'cursor'"
+            })
+        from_date, to_date = position['fd'], position['td']
+        after = (position['m'], position['d'], position['r'], position['g'], position['s'])
+    elif "fromdate" not in body:
+        return web.json_response({
+            "error": "Body must contains 'fromdate' (DATE) field"
+        })
+    elif "todate" not in body:
+        return web.json_response({
+            "error": "Body must contains 'todate' (DATE) field"
+        })
+    else:
+        from_date, to_date = body['fromdate'], body['todate']
+        after = None
+
+    # one extra row tells whether there is a next page
+    rows = []
+    async for row in emc1sp_rows(request.app, request['username'], from_date, to_date, after, limit + 1):
+        rows.append(row)
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        meter_id, reading_id, gas_id, spc_id = rows[-1][-4:]
+        next_cursor = tokens.create_cursor(
+            secret_key, usr=request.headers["username"], fd=from_date, td=to_date,
+            m=meter_id, d=rows[-1][3].strftime("%Y-%m-%d"), r=reading_id, g=gas_id, s=spc_id
+        )
+
+    return await streaming.json_response(request, {
+        'data': [emc1sp_item(row[:-4]) for row in rows],
+        'next': next_cursor
+    })
+
+
 @endpoints.post("/emc1sp/json")
 @user_keys.access_headers
+@admission.light
 async def emc1sp_json(request):
     body = await request.post()
 
+    # paginated when asked for a page size or the next page
+    if 'limit' in body or 'cursor' in body:
+        return await emc1sp_page(request, body)
+
     if "fromdate" not in body:
         return web.json_response({
             "error": "Body must contains 'fromdate' (DATE) field"
@@ -155,10 +248,15 @@ async def emc1sp_json(request):
         })
     to_date = body['todate']
 
+    if streaming.wants_ndjson(request, body):
+        return await streaming.ndjson_response(
+            request, emc1sp_query_iter(request.app, request['username'], from_date, to_date)
+        )
+
     response = []
-    async for item in emc1sp_query_iter(database.openmetrics(request.app), request['username'], from_date, to_date):
+    async for item in emc1sp_query_iter(request.app, request['username'], from_date, to_date):
         response.append(item)
 
-    return web.json_response({
+    return await streaming.json_response(request, {
         'data': response
     })
@@ -0,0 +1,33 @@
+from aiohttp import web
+from server.utility import jobs
+
+endpoints = web.RouteTableDef()
+
+
+def find_job(request):
+    if not jobs.enabled(request.app):
+        return None
+    return jobs.job_queue(request.app).get(request.match_info['job_id'])
+
+
+@endpoints.get("/jobs/{job_id}")
+async def job_status(request):
+    job = find_job(request)
+    if job is None:
+        return web.json_response({'error': "Unknown job"})
+    return web.json_response(job.status())
+
+
+@endpoints.get("/jobs/{job_id}/download")
+async def job_download(request):
+    job = find_job(request)
+    if job is None:
+        return web.json_response({'error': "Unknown job"})
+    if job.state != 'done':
+        return web.json_response({'error': f"Job is {job.state}"})
+
+    # FileResponse answers Range requests, interrupted downloads can be resumed
+    return web.FileResponse(job.path, headers={
+        'CONTENT-TYPE': job.content_type,
+        'CONTENT-DISPOSITION': f'attachment; filename="{job.filename}"'
+    })
@@ -0,0 +1,65 @@
+from aiohttp import web
+from server.utility import admission, database, export_cache, metrics, request_log, singleflight, user_keys
+
+endpoints = web.RouteTableDef()
+
+
+def state_metrics(app: web.Application):
+    # Read from the live objects at scrape time
+    pool_size = metrics.Gauge('api_db_pool_connections', 'Connections per pool and state.', ('pool', 'state'), register=False)
+    pool_waiting = metrics.Gauge('api_db_pool_waiting', 'Requests waiting for a connection.', ('pool',), register=False)
+    pool_timeouts = metrics.Counter('api_db_pool_acquire_timeouts_total', 'Connection acquisitions that timed out.', ('pool',), register=False)
+    pool_wait = metrics.Counter('api_db_pool_wait_seconds_total', 'Time spent waiting for a connection.', ('pool',), register=False)
+    for pool, stats in database.pool_stats(app).items():
+        pool_size.set(stats['idle'], pool=pool, state='idle')
+        pool_size.set(stats['acquired'], pool=pool, state='acquired')
+        pool_waiting.set(stats['waiting'], pool=pool)
+        pool_timeouts.inc(stats['timeouts'], pool=pool)
+        pool_wait.inc(stats['wait_seconds_total'], pool=pool)
+
+    request_log_entries = metrics.Counter('api_request_log_entries_total', 'request_log entries by outcome.', ('outcome',), register=False)
+    writer = request_log.writer(app)
+    request_log_entries.inc(writer.written, outcome='written')
+    request_log_entries.inc(writer.dropped, outcome='dropped')
+
+    yield from (pool_size, pool_waiting, pool_timeouts, pool_wait, request_log_entries)
+
+    admission_active = metrics.Gauge('api_admission_active', 'Requests running per admission budget.', ('budget',), register=False)
+    admission_queued = metrics.Gauge('api_admission_queued', 'Requests waiting for their turn per admission budget.', ('budget',), register=False)
+    admission_outcomes = metrics.Counter('api_admission_requests_total', 'Admission decisions per budget and outcome.', ('budget', 'outcome'), register=False)
+    admission_wait = metrics.Counter('api_admission_wait_seconds_total', 'Time requests spent waiting for their turn.', ('budget',), register=False)
+    for request_class, stats in admission.stats(app).items():
+        admission_active.set(stats['active'], budget=request_class)
+        admission_queued.set(stats['queued'], budget=request_class)
+        admission_outcomes.inc(stats['admitted'], budget=request_class, outcome='admitted')
+        admission_outcomes.inc(stats['rejected'], budget=request_class, outcome='rejected')
+        admission_outcomes.inc(stats['timeouts'], budget=request_class, outcome='timeout')
+        admission_wait.inc(stats['wait_seconds_total'], budget=request_class)
+    yield from (admission_active, admission_queued, admission_outcomes, admission_wait)
+
+    cache = export_cache.get(app)
+    if cache is not None:
+        lookups = metrics.Counter('api_export_cache_lookups_total', 'Export cache lookups by result.', ('result',), register=False)
+        lookups.inc(cache.hits, result='hit')
+        lookups.inc(cache.misses, result='miss')
+        size = metrics.Gauge('api_export_cache_bytes', 'Size of the cached exports.', register=False)
+        size.set(cache.size)
+        yield from (lookups, size)
+
+    flights = singleflight.get(app)
+    if flights is not None:
+        exports = metrics.Counter('api_singleflight_exports_total', 'Downloads that started an export or joined a running one.', ('outcome',), register=False)
+        exports.inc(flights.started, outcome='started')
+        exports.inc(flights.joined, outcome='joined')
+        running = metrics.Gauge('api_singleflight_joinable', 'Running exports identical requests can join.', register=False)
+        running.set(len(flights))
+        yield from (exports, running)
+
+
+@endpoints.get("/metrics")
+@user_keys.monitoring_access
+async def metrics_endpoint(request):
+    return web.Response(
+        body=metrics.exposition(state_metrics(request.app)).encode(),
+        headers={'CONTENT-TYPE': 'text/plain; version=0.0.4; charset=utf-8'}
+    )
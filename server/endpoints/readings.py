@@ -1,12 +1,32 @@
-import csv
 import datetime
-import io
+import functools
 
 from aiohttp import web
-from server.utility import user_keys, tokens, database, config
+from server.utility import user_keys, tokens, database, config, streaming, export_cache, unpivot, rollup, meter_access, admission, sharding, columnar, metrics
 
 endpoints = web.RouteTableDef()
 
+# Queries (openmetrics connections) one export runs at once, each over a part of the user's meters
+READINGS_EXPORT_PARALLELISM = 1
+
+meter_alias = 'm'
+reading_alias = 'r'
+
+readings_query = """SELECT /*<select_names>*/*/*</select_names>*/""" + f"""
+        FROM readings_reading AS {reading_alias}
+        INNER JOIN meters_meter AS {meter_alias} ON {meter_alias}.id = {reading_alias}.meter_id
+        WHERE {reading_alias}.meter_id = ANY(%(meter_ids)s)
+        AND date >= %(fromdate)s AND date <= %(todate)s; 
+    """
+
+
+def select_query(columns, sharded=False):
+    query = readings_query.replace('/*<select_names>*/*/*</select_names>*/', ','.join(columns))
+    if sharded:
+        # groups of meters in id order, each sorted by meter and date: concatenated in order, the rows stay sorted
+        query = database.strip_statement_end(query) + f' ORDER BY {reading_alias}.meter_id, {reading_alias}.date;'
+    return query
+
 
 def rename_args(request_args, name_table):
     for old_name, new_name in name_table.items():
@@ -24,18 +44,17 @@ async def readings_csv(request, request_args):
         'fd': 'fromdate',
         'td': 'todate',
         'usr': 'username',
-        'key': 'api_key'
+        'key': 'api_key',
+        'fmt': 'format',
+        'lay': 'layout'
     })
 
     remote_name = await user_keys.get_remote_username(
-        local_db=database.local_storage(request.app),
+        request.app,
         username=request_args['username'],
         api_key=request_args['api_key']
     )
 
-    meter_alias = 'm'
-    reading_alias = 'r'
-
     # always included in each request
     both_names = [
         f'{meter_alias}.name',
@@ -84,56 +103,70 @@ async def readings_csv(request, request_args):
     if request_args['export_reads']:
         select_names.extend(export_names)
 
-    select_query = "SELECT " + f"""
-        { ','.join(select_names) }
-        FROM readings_reading AS {reading_alias}
-        INNER JOIN meters_meter AS {meter_alias} ON {meter_alias}.id = {reading_alias}.meter_id
-        WHERE {reading_alias}.meter_id IN
-        (SELECT meter_id FROM users_profile_meters WHERE profile_id =
-        (SELECT id FROM auth_user WHERE username = %(username)s)) 
-        AND date >= %(fromdate)s AND date <= %(todate)s; 
-    """
-
+    access = await meter_access.get(request.app, remote_name)
     parameters = {
         'fromdate': request_args["fromdate"],
         'todate': request_args['todate'],
-        'username': remote_name
+        'meter_ids': access.meter_ids()
     }
 
-    csv_response = io.StringIO()
-    writer = csv.DictWriter(csv_response, select_names)
-    writer.writerow({
-        selected_column: (rename_dict.get(selected_column) or selected_column.replace(f'{reading_alias}.', ''))
+    header = [
+        rename_dict.get(selected_column) or selected_column.replace(f'{reading_alias}.', '')
         for selected_column in select_names
-    })
-
-    async with database.openmetrics(request.app) as conn:
-        async with conn.cursor() as cursor:
-            await cursor.execute(select_query, parameters)
-            async for selected_row in cursor:
-                response_row = {}
-                for selected_column, value in zip(select_names, selected_row):
-                    if isinstance(value, (datetime.date, datetime.datetime)):
-                        value = value.strftime("%Y-%m-%d")
-                    response_row[selected_column] = value
-                writer.writerow(response_row)
+    ]
 
     current_time = datetime.datetime.now().strftime('%Y%m%d%H%M')
-    filename = f"{request_args['username']}_{current_time}_csvexport.csv"
+    filename_prefix = f"{request_args['username']}_{current_time}"
 
-    response = web.StreamResponse()
-    response.headers['CONTENT-DISPOSITION'] = f'attachment; filename="{filename}"'
-    await response.prepare(request)
-    try:
-        csv_response.seek(0)
-        while True:
-            file_part = csv_response.read(4096*4096)
-            if len(file_part) <= 0:
-                break
-            await response.write(file_part.encode())
-    finally:
-        await response.write_eof()
-    return response
+    # credentials are replaced by the account they resolve to
+    cache_args = {name: value for name, value in request_args.items() if name not in ('username', 'api_key')}
+    cache_args['remote_name'] = remote_name
+
+    export_format = request_args.get('format', 'csv')
+    layout = request_args.get('layout', 'wide')
+    cache = export_cache.entry(
+        request.app, tokens.handler_name(readings_csv), cache_args, request_args['todate'], parameters['meter_ids']
+    )
+
+    workers = sharding.parallelism(request.app, 'READINGS_EXPORT_PARALLELISM', READINGS_EXPORT_PARALLELISM)
+    meter_shards = sharding.split(parameters['meter_ids'], sharding.shard_count(request.app, workers))
+    sharded_export = workers > 1 and len(meter_shards) > 1
+    if sharded_export:
+        shard_parameters = [{**parameters, 'meter_ids': meter_ids} for meter_ids in meter_shards]
+    else:
+        shard_parameters = [parameters]
+
+    def sharded(source, batch_size):
+        # source(parameters, first) of every shard, one after the other
+        if len(shard_parameters) == 1:
+            return source(shard_parameters[0], True)
+        return sharding.concatenated([
+            functools.partial(source, shard, index == 0) for index, shard in enumerate(shard_parameters)
+        ], workers, batch_size=batch_size, prefetch=sharding.prefetch_size(request.app))
+
+    if export_format == 'csv' and layout == 'wide' and database.copy_available(request.app):
+        # Renames and date formatting are plain SQL here: Postgres writes the CSV itself
+        copy_query = select_query(
+            [f'{name} AS "{column}"' for name, column in zip(select_names, header)], sharded_export
+        )
+        return await streaming.send_attachment(
+            request, streaming.export_filename(filename_prefix, export_format),
+            sharded(lambda shard, first: database.openmetrics_copy(
+                request.app, copy_query, shard, chunk_size=streaming.chunk_size(request.app), header=first,
+                handler=metrics.handler_name(request)
+            ), 1),
+            cache=cache
+        )
+
+    description = []
+    return await streaming.send_export(
+        request, filename_prefix, export_format,
+        header, sharded(lambda shard, first: database.openmetrics_rows(
+            request.app, select_query(select_names, sharded_export), shard, description=description
+        ), database.itersize(request.app)),
+        cache=cache, unpivot=unpivot.Unpivot(header) if layout == 'long' else None,
+        types=lambda: columnar.described_types(description)
+    )
 
 
 @endpoints.post("/readings/csv_token")
@@ -158,14 +191,108 @@ async def readings_csv_token(request):
             "error": "Body must contains 'todate' (DATE) field"
         })
 
-    return web.json_response({
-        'token': tokens.create_request_token(config(request.app, 'SECRET_KEY'), readings_csv, **{
-            'ir': include_imports,
-            'er': include_exports,
-            'fd': post_body['fromdate'],
-            'td': post_body['todate'],
-            'usr': request.headers["username"],
-            'key': request.headers["api-key"],
+    export_format = post_body.get('format', 'csv')
+    format_error = streaming.format_error(export_format)
+    if format_error is not None:
+        return web.json_response({
+            "error": format_error
+        })
+
+    layout = post_body.get('layout', 'wide')
+    layout_error = unpivot.layout_error(layout)
+    if layout_error is not None:
+        return web.json_response({
+            "error": layout_error
         })
+
+    token_data = {
+        'ir': include_imports,
+        'er': include_exports,
+        'fd': post_body['fromdate'],
+        'td': post_body['todate'],
+        'usr': request.headers["username"],
+        'key': request.headers["api-key"],
+    }
+    if export_format != 'csv':
+        token_data['fmt'] = export_format
+    if layout != 'wide':
+        token_data['lay'] = layout
+
+    return web.json_response({
+        'token': tokens.create_request_token(config(request.app, 'SECRET_KEY'), readings_csv, **token_data)
     })
 
+
+@endpoints.post("/readings/rollup")
+@user_keys.access_headers
+@admission.light
+async def readings_rollup(request):
+    body = await request.post()
+
+    period = body.get('period', 'month')
+    if period not in rollup.PERIODS:
+        return web.json_response({
+            "error": f"'period' must be one of: {', '.join(rollup.PERIODS)}"
+        })
+
+    if "fromdate" not in body:
+        return web.json_response({
+            "error": "Body must contains 'fromdate' (DATE) field"
+        })
+    from_date = body['fromdate']
+
+    if "todate" not in body:
+        return web.json_response({
+            "error": "Body must contains 'todate' (DATE) field"
+        })
+    to_date = body['todate']
+
+    try:
+        datetime.date.fromisoformat(from_date)
+    except ValueError:
+        return web.json_response({
+            "error": "'fromdate' must be a date (YYYY-MM-DD)"
+        })
+
+    try:
+        to_day = datetime.date.fromisoformat(to_date)
+    except ValueError:
+        return web.json_response({
+            "error": "'todate' must be a date (YYYY-MM-DD)"
+        })
+
+    access = await meter_access.get(request.app, request['username'])
+    meter_ids = access.meter_ids()
+
+    # Complete periods come from the rollup tables, the rest (current period included) is summed up on the fly
+    rolled_up_to = await rollup.rolled_up_to(request.app, period)
+    rows = []
+    if rolled_up_to is not None:
+        rows.extend(await rollup.stored_totals(request.app, period, meter_ids, from_date, to_date, rolled_up_to))
+    if rolled_up_to is None or rolled_up_to <= to_day:
+        async for row in rollup.live_totals(request.app, period, meter_ids, from_date, to_date, rolled_up_to):
+            rows.append(row)
+    rows.sort(key=lambda row: (row[0], row[1]))
+
+    today = datetime.date.today()
+    response = []
+    for meter_id, period_start, days, *totals in rows:
+        item = {
+            'name': access.meters[meter_id].name,
+            'reference': access.meters[meter_id].mpan,
+            'description': access.meters[meter_id].location,
+            'period': period,
+            'period_start': period_start.strftime("%Y-%m-%d"),
+            'days': days,
+            'partial': rollup.period_end(period, period_start) > today,
+            **dict(zip(rollup.TOTAL_FIELDS, totals)),
+        }
+        if item['generation_kwh'] is not None and item['battery_charge_kwh'] is not None:
+            item['solar_generation_kwh'] = item['generation_kwh'] - item['battery_charge_kwh']
+        else:
+            item['solar_generation_kwh'] = None
+        response.append(item)
+
+    return await streaming.json_response(request, {
+        'data': response
+    })
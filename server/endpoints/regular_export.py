@@ -1,4 +1,5 @@
 from server.utility.exporter import *
+from server.utility import export_cache
 
 endpoints = web.RouteTableDef()
 
@@ -57,65 +58,32 @@ class RegularExport(DefaultExporter):
     def meter_type(self):
         return "SP"
 
-    async def process_meter(self, meter):
-        elements = list()
-        readings = self.get_readings(meter=meter)
-        async for reading_elem in readings:
-            element = dict()
-            reading = Reading(reading_elem, meter)
-            for field_name in self.get_fields():
-                element[field_name] = await self.field_handler(field_name, meter, reading)
-            elements.append(element)
-        return elements
-
-    async def field_handler(self, field, meter, reading):
-        fields = dict()
-
-        fields['serial'] = meter.meter['name']
-        fields['reading_id'] = reading.reading['reading_id']
-        fields['mpan'] = str(meter.meter['mpan'])
-        fields['location'] = meter.meter['location']
-        fields['date'] = reading.reading['date']
-        fields['import_total'] = (reading.reading['import_total'] or 0) * 0.001
-        fields['import_daily'] = reading.reading['import_daily']
-        fields['export_total'] = (reading.reading['export_total'] or 0) * 0.001
-        fields['export_daily'] = reading.reading['export_daily']
-        fields['extra_total'] = (reading.reading['extra_total'] or 0) * 0.001
-        fields['extra_daily'] = reading.reading['extra_daily']
-        fields['utilisation_total'] = abs((reading.reading['extra_total'] - reading.reading['import_total']) * 0.001)
-        fields['utilisation_daily'] = (reading.reading['extra_daily'] - reading.reading['import_daily'])
+    def field_sources(self):
+        sources = {
+            'serial': 'name',
+            'reading_id': 'reading_id',
+            'mpan': (str, 'mpan'),
+            'location': 'location',
+            'date': 'date',
+            'import_total': (wh_to_kwh, 'import_total'),
+            'import_daily': 'import_daily',
+            'export_total': (wh_to_kwh, 'export_total'),
+            'export_daily': 'export_daily',
+            'extra_total': (wh_to_kwh, 'extra_total'),
+            'extra_daily': 'extra_daily',
+            'utilisation_total': (lambda extra, imported: abs((extra - imported) * 0.001), 'extra_total', 'import_total'),
+            'utilisation_daily': (operator.sub, 'extra_daily', 'import_daily'),
+        }
 
         for number in self.times:
-            fields[f'import{number}'] = reading.reading[f'import{number}']
-            fields[f'export{number}'] = reading.reading[f'export{number}']
-            fields[f'export{number}_b'] = reading.reading[f'export{number}_b']
+            sources[f'import{number}'] = f'import{number}'
+            sources[f'export{number}'] = f'export{number}'
+            sources[f'export{number}_b'] = f'export{number}_b'
 
         for number in self.times_utilisation:
-            fields[f'utilisation{number}'] = (reading.reading[f'export{number}_b'] - reading.reading[f'export{number}'])
-
-        return fields[field]
-
-    async def get_readings(self, meter):
-        field_names = self.reading_fields().values()
-
-        query = """SELECT /*<select_names>*/*/*</select_names>*/ FROM readings_reading as reading
-                    WHERE reading.meter_id=%(meter_id)s 
-                    AND %(date_from)s <= reading.date AND reading.date <= %(date_to)s
-                    ORDER BY reading.date
-              ;""".replace('/*<select_names>*/*/*</select_names>*/', ','.join(field_names))
-
-        async with database.openmetrics(self.request.app) as connection:
-            async with connection.cursor() as cursor:
-                await cursor.execute(query, {
-                    'meter_id': meter.meter['id'],
-                    'date_from': self.get_date_from(),
-                    'date_to': self.get_date_to()
-                })
-                async for row in cursor:
-                    response_item = dict(zip(self.reading_fields(), row))
-                    if 'date' in response_item:
-                        response_item['date'] = response_item['date'].strftime("%Y-%m-%d")
-                    yield response_item
+            sources[f'utilisation{number}'] = (operator.sub, f'export{number}_b', f'export{number}')
+
+        return sources
 
     def reading_fields(self):
         return {
@@ -142,31 +110,23 @@ class RegularExport(DefaultExporter):
         }
 
 
-class Reading:
-    def __init__(self, reading, meter):
-        self.reading = reading
-        self.meter = meter
-
-
 @endpoints.post('/regular/csv_token')
 async def regular_csv_token(request):
     regular = RegularExport(request)
     return await regular.token(request, regular_csv)
 
 
-@tokens.register_token_handler('spc/export')
+@tokens.register_token_handler('regular/export')
 async def regular_csv(request, request_args):
     regular = RegularExport(request, request_args)
-    filename = f"{regular.get_username()}_{regular.current_time}_csvexport.csv"
-
-    response = web.StreamResponse()
-    response.headers['CONTENT-DISPOSITION'] = f'attachment; filename="{filename}"'
-    await response.prepare(request)
-
-    try:
-        for file_part in await regular.export(request, request_args):
-            await response.write(file_part.encode())
-    finally:
-        await response.write_eof()
-    return response
-
+    filename_prefix = f"{regular.get_username()}_{regular.current_time}"
+    rows, projection, types = regular.export(request, request_args)
+
+    return await streaming.send_export(
+        request, filename_prefix, regular.get_format(), regular.get_fields(), rows,
+        cache=export_cache.entry(
+            request.app, tokens.handler_name(regular_csv), request_args, regular.get_date_to(),
+            await regular.meter_ids()
+        ),
+        projection=projection, unpivot=regular.get_unpivot(), types=types
+    )
@@ -1,4 +1,5 @@
 from server.utility.exporter import *
+from server.utility import export_cache
 
 endpoints = web.RouteTableDef()
 
@@ -51,70 +52,24 @@ class SPCExport(DefaultExporter):
     def meter_type(self):
         return "SP"
 
-    async def process_meter(self, meter):
-        elements = list()
-        readings = self.get_readings(meter=meter)
-        async for reading_elem in readings:
-            element = dict()
-            reading = Reading(reading_elem, meter)
-            for field_name in self.get_fields():
-                element[field_name] = await self.field_handler(field_name, meter, reading)
-            elements.append(element)
-        return elements
-
-    async def field_handler(self, field, meter, reading):
-        fields = dict()
-
-        fields['serial'] = meter.meter['name']
-        fields['reading_id'] = reading.reading['reading_id']
-        fields['mpan'] = meter.meter['mpan']
-        fields['location'] = meter.meter['location']
-        fields['date'] = reading.reading['date']
-        fields['domestic_load_total'] = reading.reading['domestic_load_total'],
-        fields['domestic_load_daily'] = reading.reading['domestic_load_daily']
-        fields['utilised_total'] = reading.reading['utilised_total'],
-        fields['utilised_daily'] = reading.reading['utilised_daily'],
-        fields['grid_export_total'] = reading.reading['grid_export_total'],
-        fields['grid_export_daily'] = reading.reading['grid_export_daily'],
-        fields['grid_energy_total'] = reading.reading['grid_energy_total'],
-        fields['charge_total'] = reading.reading['charge_total'],
-        fields['charge_daily'] = reading.reading['charge_daily'],
-        fields['generation_total'] = reading.reading['generation_total'],
-        fields['generation_daily'] = reading.reading['generation_daily']
-
-        for number in self.times:
-            fields[f'domestic_load{number}'] = reading.reading[f'domestic_load{number}']
-            fields[f'grid_energy{number}'] = reading.reading[f'grid_energy{number}']
-            fields[f'utilised{number}'] = reading.reading[f'utilised{number}']
-            fields[f'charge{number}'] = reading.reading[f'charge{number}']
-            fields[f'generation{number}'] = reading.reading[f'generation{number}']
-            fields[f'grid_export{number}'] = reading.reading[f'grid_export{number}']
-
-        return fields[field]
-
-    async def get_readings(self, meter):
-        field_names = self.reading_fields().values()
-
-        query = """SELECT /*<select_names>*/*/*</select_names>*/ FROM readings_reading as reading
-                    INNER JOIN readings_spcreading as spc_reading
-                      ON reading.meter_id = spc_reading.meter_id AND reading.date = spc_reading.date
-                    WHERE reading.meter_id=%(meter_id)s 
-                    AND %(date_from)s <= reading.date AND reading.date <= %(date_to)s
-                    ORDER BY reading.date
-              ;""".replace('/*<select_names>*/*/*</select_names>*/', ','.join(field_names))
-
-        async with database.openmetrics(self.request.app) as connection:
-            async with connection.cursor() as cursor:
-                await cursor.execute(query, {
-                    'meter_id': meter.meter['id'],
-                    'date_from': self.get_date_from(),
-                    'date_to': self.get_date_to()
-                })
-                async for row in cursor:
-                    response_item = dict(zip(self.reading_fields(), row))
-                    if 'date' in response_item:
-                        response_item['date'] = response_item['date'].strftime("%Y-%m-%d")
-                    yield response_item
+    def field_sources(self):
+        sources = {
+            'serial': 'name',
+            'reading_id': 'reading_id',
+            'mpan': 'mpan',
+            'location': 'location',
+            'date': 'date',
+        }
+
+        # every other field is a plain reading column of the same name
+        for field_name in self.fields():
+            sources.setdefault(field_name, field_name)
+
+        return sources
+
+    def readings_join(self):
+        return """INNER JOIN readings_spcreading as spc_reading
+                      ON reading.meter_id = spc_reading.meter_id AND reading.date = spc_reading.date"""
 
     def reading_fields(self):
         return {
@@ -159,12 +114,6 @@ class SPCExport(DefaultExporter):
         }
 
 
-class Reading:
-    def __init__(self, reading, meter):
-        self.reading = reading
-        self.meter = meter
-
-
 @endpoints.post('/spc/csv_token')
 async def spc_csv_token(request):
     spc = SPCExport(request)
@@ -174,15 +123,13 @@ async def spc_csv_token(request):
 @tokens.register_token_handler('spc/export')
 async def spc_csv(request, request_args):
     spc = SPCExport(request, request_args)
-    filename = f"{spc.get_username()}_{spc.current_time}_csvexport.csv"
-
-    response = web.StreamResponse()
-    response.headers['CONTENT-DISPOSITION'] = f'attachment; filename="{filename}"'
-    await response.prepare(request)
-
-    try:
-        for file_part in await spc.export(request, request_args):
-            await response.write(file_part.encode())
-    finally:
-        await response.write_eof()
-    return response
+    filename_prefix = f"{spc.get_username()}_{spc.current_time}"
+    rows, projection, types = spc.export(request, request_args)
+
+    return await streaming.send_export(
+        request, filename_prefix, spc.get_format(), spc.get_fields(), rows,
+        cache=export_cache.entry(
+            request.app, tokens.handler_name(spc_csv), request_args, spc.get_date_to(), await spc.meter_ids()
+        ),
+        projection=projection, unpivot=spc.get_unpivot(), types=types
+    )
@@ -0,0 +1,22 @@
+from aiohttp import web
+from server.utility import admission, database, user_keys
+
+endpoints = web.RouteTableDef()
+
+
+@endpoints.get("/status/pools")
+@user_keys.monitoring_access
+async def pool_status(request):
+    return web.json_response(database.pool_stats(request.app))
+
+
+@endpoints.get("/status/queries")
+@user_keys.monitoring_access
+async def query_status(request):
+    return web.json_response(database.query_stats(request.app))
+
+
+@endpoints.get("/status/admission")
+@user_keys.monitoring_access
+async def admission_status(request):
+    return web.json_response(admission.stats(request.app))
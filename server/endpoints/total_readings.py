@@ -1,33 +1,28 @@
 from aiohttp import web
-from server.utility import user_keys, database
+from server.utility import user_keys, database, streaming, meter_access, admission
 
 endpoints = web.RouteTableDef()
 
-
-@endpoints.post("/total_readings/json")
-@user_keys.access_headers
-@user_keys.access_logging
-async def total_readings_json(request):
-    # noinspection SqlResolve
-    select_query = """
+# noinspection SqlResolve
+select_query = """
         SELECT
-        m.id,
-        m.name,
+        r.meter_id,
         r.date,
         r.import_total_wh,
         r.import_total
-        FROM meters_meter AS m
-        INNER JOIN users_profile_meters AS u ON (m.id=u.meter_id)
-        INNER JOIN auth_user AS a ON (u.profile_id=a.id)
-        INNER JOIN readings_reading AS r ON (m.id=r.meter_id)
+        FROM readings_reading AS r
         WHERE
-        a.username = %(username)s
+        r.meter_id = ANY(%(meter_ids)s) -- the requested meters of the user
         AND
         r.date = %(date)s
-        AND
-        m.name IN %(meters)s
     """
 
+
+@endpoints.post("/total_readings/json")
+@user_keys.access_headers
+@user_keys.access_logging
+@admission.light
+async def total_readings_json(request):
     post_body = await request.post()
 
     if 'date' not in post_body:
@@ -40,25 +35,33 @@ async def total_readings_json(request):
             "error": "Body must contains at least one 'meters' (STRING) field"
         })
 
+    # names come from the meter access cache, meters_meter is not read
+    access = await meter_access.get(request.app, request["username"])
     parameters = {
-        'username': request["username"],
+        'meter_ids': access.meter_ids(post_body.getall('meters')),
         'date': post_body['date'],
-        'meters': tuple(post_body.getall('meters'))
     }
 
+    streamed = streaming.wants_ndjson(request, post_body)
+    rows = database.openmetrics_rows(request.app, select_query, parameters, server_side=streamed)
+
+    async def response_items():
+        async for meter_id, date, import_total_wh, import_total in rows:
+            yield {
+                "id": meter_id,
+                "name": access.meters[meter_id].name,
+                "date": date.strftime("%Y-%m-%d"),
+                "import_total_wh": import_total_wh,
+                "import_total": import_total
+            }
+
+    if streamed:
+        return await streaming.ndjson_response(request, response_items())
+
     response = []
-    async with database.openmetrics(request.app) as conn:
-        async with conn.cursor() as cursor:
-            await cursor.execute(select_query, parameters)
-            async for meter_id, name, date, import_total_wh, import_total in cursor:
-                response.append({
-                    "id": meter_id,
-                    "name": name,
-                    "date": date.strftime("%Y-%m-%d"),
-                    "import_total_wh": import_total_wh,
-                    "import_total": import_total
-                })
+    async for item in response_items():
+        response.append(item)
 
-    return web.json_response({
+    return await streaming.json_response(request, {
         "data": response
     })
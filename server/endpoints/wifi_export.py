@@ -1,12 +1,14 @@
-import csv
 import datetime
-import io
+import functools
 
 from aiohttp import web
-from server.utility import database, tokens, config
+from server.utility import database, tokens, config, streaming, export_cache, meter_access, sharding, columnar
 
 endpoints = web.RouteTableDef()
 
+# Queries (openmetrics connections) one export runs at once, each over a part of the date range
+WIFI_EXPORT_PARALLELISM = 1
+
 
 def wifi_field_names():
     return {
@@ -37,113 +39,139 @@ async def wifi_csv_token(request):
     for field in request_data.getall('fields'):
         if field not in valid_fields:
             return web.json_response({'error': f"invalid name '{field}' in 'fields'"})
+    export_format = request_data.get('format', 'csv')
+    format_error = streaming.format_error(export_format)
+    if format_error is not None:
+        return web.json_response({'error': format_error})
 
     token_data = {
         'date_from': request_data['date_from'],
         'date_to': request_data['date_to'],
         'fields': request_data.getall('fields'),
     }
+    if export_format != 'csv':
+        token_data['format'] = export_format
 
     return web.json_response({
         'token': tokens.create_request_token(config(request.app, 'SECRET_KEY'), wifi_csv, **token_data)
     })
 
 
-async def wifi_iter(app, username, slugs, fields, date_from, date_to):
-    # Collect field names like in DB
-    field_names = wifi_field_names()
-    select_names = [field_names[field] for field in fields]
-
-    select_query = f"""
+wifi_query = """
       SELECT /*<select_names>*/*/*</select_names>*/
       FROM readings_wifireading as wifi_reading
         INNER JOIN meters_meter as meter
           ON wifi_reading.meter_id = meter.id
-      WHERE meter.id IN (
-        SELECT profile_meters.meter_id
-        FROM users_profile_meters as profile_meters
-          INNER JOIN meters_meter as meter
-          ON meter.id = profile_meters.meter_id
-        WHERE (
-            %(empty_slugs)s OR -- TRUE if no slugs 
-            meter.name IN %(slugs)s
-          )
-          AND (
-            %(all_users)s OR -- True if superuser
-            profile_meters.profile_id = (SELECT auth_user.id FROM auth_user WHERE auth_user.username = %(username)s)
-          )
-      )
+      WHERE (
+          %(empty_slugs)s OR -- TRUE if no slugs 
+          meter.name IN %(slugs)s
+        )
+        AND (
+          %(all_users)s OR -- True if superuser
+          meter.id = ANY(%(meter_ids)s) -- the user's meters, already narrowed by slugs
+        )
       AND %(date_from)s <= wifi_reading.datetime AND wifi_reading.datetime <= %(date_to)s
+      /*<shard>*/
       ORDER BY wifi_reading.datetime
     ;
-    """.replace('/*<select_names>*/*/*</select_names>*/', ','.join(select_names))
-
-    async with database.openmetrics(app) as connection:
-        async with connection.cursor() as cursor:
-            await cursor.execute(select_query, {
-                'empty_slugs': not slugs,
-                # avoid sql syntax error: 'meter.name IN ()'
-                #                                     ^^^^^
-                'slugs': slugs if slugs else ('',),
-                'all_users': username is None,
-                'username': '' if username is None else username,
-                'date_from': date_from,
-                'date_to': date_to,
-            })
-            async for row in cursor:
-                response_item = dict(zip(fields, row))
-                print(response_item)
-                if 'date' in response_item:
-                    response_item['date'] = response_item['date'].strftime("%Y-%m-%d")
-                yield response_item
-
-
-async def wifi_csv_iter(app, username, slugs, fields, date_from, date_to):
-    csv_response = io.StringIO()
-    writer = csv.DictWriter(csv_response, fields)
-    writer.writeheader()
-
-    wifi_export_iterator = wifi_iter(
-        app=app,
-        username=username,
-        slugs=slugs,
-        fields=fields,
-        date_from=date_from,
-        date_to=date_to,
-    )
-    async for response_row in wifi_export_iterator:
-        writer.writerow(response_row)
-        if csv_response.tell() > 4096*4096:
-            csv_response.seek(0)
-            yield csv_response.read()
-            csv_response.truncate()
+    """
+
 
-    if csv_response.tell() > 0:
-        csv_response.seek(0)
-        yield csv_response.read()
+def select_query(select_names, sharded=False):
+    # sharded: the part of the range from %(shard_from)s to %(shard_to)s only
+    shard = 'AND %(shard_from)s <= wifi_reading.datetime AND wifi_reading.datetime < %(shard_to)s' if sharded else ''
+    return wifi_query.replace(
+        '/*<select_names>*/*/*</select_names>*/', ','.join(select_names)
+    ).replace('/*<shard>*/', shard)
+
+
+async def wifi_meter_ids(app, username, slugs):
+    # meters of the export, those of every user for the superuser (username None)
+    if username is None:
+        return await meter_access.all_meter_ids(app, slugs)
+    access = await meter_access.get(app, username)
+    return access.meter_ids(slugs)
+
+
+async def wifi_rows(app, username, slugs, fields, date_from, date_to, description=None):
+    # Collect field names like in DB
+    field_names = wifi_field_names()
+    select_names = [field_names[field] for field in fields]
+
+    if username is None:
+        meter_ids = []
+    else:
+        access = await meter_access.get(app, username)
+        meter_ids = access.meter_ids(slugs)
+
+    parameters = {
+        'empty_slugs': not slugs,
+        # avoid sql syntax error: 'meter.name IN ()'
+        #                                     ^^^^^
+        'slugs': tuple(slugs) if slugs else ('',),
+        'all_users': username is None,
+        'meter_ids': meter_ids,
+        'date_from': date_from,
+        'date_to': date_to,
+    }
+    workers = sharding.parallelism(app, 'WIFI_EXPORT_PARALLELISM', WIFI_EXPORT_PARALLELISM)
+    ranges = sharding.date_ranges(date_from, date_to, sharding.shard_count(app, workers)) if workers > 1 else None
+    if ranges and len(ranges) > 1:
+        # consecutive datetime ranges, each sorted by datetime: concatenated in order, the rows stay sorted
+        shard_query = select_query(select_names, sharded=True)
+        rows = sharding.concatenated([
+            functools.partial(
+                database.openmetrics_rows, app, shard_query, {**parameters, 'shard_from': start, 'shard_to': end},
+                description=description
+            )
+            for start, end in ranges
+        ], workers, batch_size=database.itersize(app), prefetch=sharding.prefetch_size(app))
+    else:
+        rows = database.openmetrics_rows(app, select_query(select_names), parameters, description=description)
+    try:
+        async for row in rows:
+            yield row
+    finally:
+        await rows.aclose()
+
+
+def wifi_projection(fields):
+    # 'date' is the reading datetime, exported as a day
+    if 'date' not in fields:
+        return None
+    date_index = fields.index('date')
+
+    def projection(row):
+        row = list(row)
+        row[date_index] = row[date_index].strftime("%Y-%m-%d")
+        return row
+
+    return projection
 
 
 @tokens.register_token_handler('wifi/export')
 async def wifi_csv(request, request_args):
     current_time = datetime.datetime.now().strftime('%Y%m%d%H%M')
-    filename = f"{request_args.get('username', '_SUPERUSER')}_{current_time}_csvexport.csv"
-
-    response = web.StreamResponse()
-    response.headers['CONTENT-DISPOSITION'] = f'attachment; filename="{filename}"'
-    await response.prepare(request)
+    filename_prefix = f"{request_args.get('username', '_SUPERUSER')}_{current_time}"
 
-    csv_iterator = wifi_csv_iter(
+    fields = request_args['fields']
+    description = []
+    rows = wifi_rows(
         app=request.app,
         username=request_args.get('username'),
         slugs=request_args.get('slugs', []),
-        fields=request_args['fields'],
+        fields=fields,
         date_from=request_args['date_from'],
         date_to=request_args['date_to'],
+        description=description,
+    )
+    # 'date' is formatted by the projection, the other fields are the selected columns
+    sources = [None if field == 'date' else index for index, field in enumerate(fields)]
+    return await streaming.send_export(
+        request, filename_prefix, request_args.get('format', 'csv'), fields, rows,
+        cache=export_cache.entry(
+            request.app, tokens.handler_name(wifi_csv), request_args, request_args['date_to'],
+            await wifi_meter_ids(request.app, request_args.get('username'), request_args.get('slugs', []))
+        ),
+        projection=wifi_projection(fields), types=lambda: columnar.described_types(description, sources)
     )
-
-    try:
-        async for file_part in csv_iterator:
-            await response.write(file_part.encode())
-    finally:
-        await response.write_eof()
-    return response
@@ -1,7 +1,12 @@
-def config(app, name):
+__MISSING = object()
+
+
+def config(app, name, default=__MISSING):
     if hasattr(app['config'], name):
         return getattr(app['config'], name)
     try:
         return app['config'][name]
     except (TypeError, KeyError):
+        if default is not __MISSING:
+            return default
         raise AttributeError(f'"{name}" is not configured')
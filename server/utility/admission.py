@@ -0,0 +1,173 @@
+import asyncio
+import collections
+import math
+import time
+
+from aiohttp import web
+
+from server.utility import config
+
+# Requests running at once per class: "heavy" /download exports and "light" JSON endpoints.
+# Keep the heavy budget below OPENMETRICS_POOL_MAXSIZE so light requests always find a connection.
+ADMISSION_HEAVY_CONCURRENCY = 4
+ADMISSION_LIGHT_CONCURRENCY = 16
+# Requests of one key (api username, or export user) running at once per class
+ADMISSION_HEAVY_PER_KEY = 2
+ADMISSION_LIGHT_PER_KEY = 8
+# Requests waiting per class, further ones are answered 429 right away
+ADMISSION_QUEUE_SIZE = 50
+# Seconds a request waits for its turn before it is answered 429
+ADMISSION_HEAVY_QUEUE_TIMEOUT = 30
+ADMISSION_LIGHT_QUEUE_TIMEOUT = 5
+
+__BUDGETS = 'ADMISSION_BUDGETS'
+
+
+class Rejected(Exception):
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Budget:
+    # Concurrency limit of one class of requests with a per key cap, waiting requests are served in order
+    # except that the ones of a key at its cap do not hold back the others
+    def __init__(self, concurrency, per_key, queue_size, queue_timeout):
+        self.concurrency = concurrency
+        self.per_key = per_key
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.running = collections.Counter()  # key -> running requests
+        self.active = 0
+        self.waiting = collections.deque()  # (key, future)
+        self.average_seconds = 0.0  # exponentially weighted time a request runs
+        self.admitted = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def retry_after(self):
+        # seconds until the queue has probably moved on
+        return max(1, math.ceil(self.average_seconds * (len(self.waiting) + 1) / self.concurrency))
+
+    def can_run(self, key):
+        return self.active < self.concurrency and self.running[key] < self.per_key
+
+    async def acquire(self, key):
+        # waiting requests are all held back by their key's cap while there is room, see release()
+        if self.can_run(key) and not any(waiting_key == key for waiting_key, _ in self.waiting):
+            self.start(key)
+            return
+        if len(self.waiting) >= self.queue_size:
+            self.rejected += 1
+            raise Rejected('too many requests are waiting, try again later', self.retry_after())
+
+        future = asyncio.get_event_loop().create_future()
+        entry = (key, future)
+        self.waiting.append(entry)
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.queue_timeout)
+        except asyncio.TimeoutError:
+            if not future.done():
+                self.waiting.remove(entry)
+                self.timeouts += 1
+                raise Rejected('the request waited too long for its turn, try again later', self.retry_after())
+        except asyncio.CancelledError:
+            if future.done():
+                self.release(key, 0)  # admitted just as the client went away
+            else:
+                self.waiting.remove(entry)
+            raise
+        finally:
+            waited = time.monotonic() - started
+            self.wait_seconds += waited
+            self.max_wait_seconds = max(self.max_wait_seconds, waited)
+
+    def start(self, key):
+        self.active += 1
+        self.running[key] += 1
+        self.admitted += 1
+
+    def release(self, key, seconds):
+        self.active -= 1
+        self.running[key] -= 1
+        if not self.running[key]:
+            del self.running[key]
+        if seconds:
+            self.average_seconds += (seconds - self.average_seconds) * (0.1 if self.average_seconds else 1)
+        for entry in list(self.waiting):
+            if self.active >= self.concurrency:
+                break
+            waiting_key, future = entry
+            if self.running[waiting_key] < self.per_key:
+                self.waiting.remove(entry)
+                self.start(waiting_key)
+                future.set_result(None)
+
+    def stats(self):
+        return {
+            'concurrency': self.concurrency,
+            'per_key': self.per_key,
+            'active': self.active,
+            'queued': len(self.waiting),
+            'keys': len(self.running),
+            'admitted': self.admitted,
+            'rejected': self.rejected,
+            'timeouts': self.timeouts,
+            'wait_seconds_total': self.wait_seconds,
+            'wait_seconds_max': self.max_wait_seconds,
+            'average_seconds': self.average_seconds,
+        }
+
+
+async def admission_ctx(app: web.Application):
+    queue_size = int(config(app, 'ADMISSION_QUEUE_SIZE', ADMISSION_QUEUE_SIZE))
+    app[__BUDGETS] = {
+        'heavy': Budget(
+            int(config(app, 'ADMISSION_HEAVY_CONCURRENCY', ADMISSION_HEAVY_CONCURRENCY)),
+            int(config(app, 'ADMISSION_HEAVY_PER_KEY', ADMISSION_HEAVY_PER_KEY)),
+            queue_size,
+            float(config(app, 'ADMISSION_HEAVY_QUEUE_TIMEOUT', ADMISSION_HEAVY_QUEUE_TIMEOUT)),
+        ),
+        'light': Budget(
+            int(config(app, 'ADMISSION_LIGHT_CONCURRENCY', ADMISSION_LIGHT_CONCURRENCY)),
+            int(config(app, 'ADMISSION_LIGHT_PER_KEY', ADMISSION_LIGHT_PER_KEY)),
+            queue_size,
+            float(config(app, 'ADMISSION_LIGHT_QUEUE_TIMEOUT', ADMISSION_LIGHT_QUEUE_TIMEOUT)),
+        ),
+    }
+    yield  # <!> Do not remove this yield
+
+
+def stats(app: web.Application):
+    return {name: budget.stats() for name, budget in app[__BUDGETS].items()}
+
+
+def too_many_requests(rejected: Rejected):
+    return web.json_response({
+        'error': str(rejected)
+    }, status=429, headers={'RETRY-AFTER': str(rejected.retry_after)})
+
+
+async def admitted(request, request_class, key, handler):
+    # Response of handler(), run once the budget of request_class lets key in, or 429
+    budget: Budget = request.app[__BUDGETS][request_class]
+    try:
+        await budget.acquire(key)
+    except Rejected as rejected:
+        return too_many_requests(rejected)
+
+    started = time.monotonic()
+    try:
+        return await handler()
+    finally:
+        budget.release(key, time.monotonic() - started)
+
+
+def light(async_handler):
+    # For JSON endpoints behind access_headers, the api username is the key
+    async def async_wrapper(request):
+        return await admitted(request, 'light', request.headers["username"], lambda: async_handler(request))
+    return async_wrapper
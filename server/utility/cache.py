@@ -0,0 +1,47 @@
+import collections
+import time
+
+
+class TTLCache:
+    # LRU mapping with a bounded size where every entry expires "ttl" seconds after it was set
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.__entries = collections.OrderedDict()
+        # bumped by invalidate(): a value loaded while it changed may predate the invalidation and is not stored
+        self.generation = 0
+
+    def get(self, key, default=None):
+        try:
+            expires_at, value = self.__entries[key]
+        except KeyError:
+            return default
+        if expires_at <= time.monotonic():
+            del self.__entries[key]
+            return default
+        self.__entries.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl=None):
+        self.__entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self.__entries.move_to_end(key)
+        while len(self.__entries) > self.maxsize:
+            self.__entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        try:
+            return self.__entries.pop(key)[1]
+        except KeyError:
+            return default
+
+    def invalidate(self):
+        self.generation += 1
+
+    def keys(self):
+        return list(self.__entries)
+
+    def clear(self):
+        self.__entries.clear()
+
+    def __len__(self):
+        return len(self.__entries)
@@ -0,0 +1,168 @@
+import io
+import itertools
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:  # optional dependency, only needed for "parquet" and "arrow" exports
+    pyarrow = None
+
+# Rows per record batch (and per parquet row group)
+ARROW_BATCH_SIZE = 65536
+
+
+def available():
+    return pyarrow is not None
+
+
+class _Sink(io.RawIOBase):
+    # Write-only file handing out what was written so far, keeps counting positions for the parquet footer
+    def __init__(self):
+        super().__init__()
+        self.position = 0
+        self.parts = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = bytes(data)
+        self.parts.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b''.join(self.parts)
+        self.parts = []
+        return data
+
+
+def column_type(type_code):
+    # arrow type of a Postgres column type (pg_type oid), None when it is left to inference
+    if type_code in (20, 21, 23):  # int8, int2, int4
+        return pyarrow.int64()
+    if type_code in (700, 701):  # float4, float8
+        return pyarrow.float64()
+    if type_code in (25, 1042, 1043):  # text, bpchar, varchar
+        return pyarrow.string()
+    if type_code == 16:
+        return pyarrow.bool_()
+    if type_code == 1082:
+        return pyarrow.date32()
+    if type_code == 1114:
+        return pyarrow.timestamp('us')
+    if type_code == 1184:
+        return pyarrow.timestamp('us', tz='UTC')
+    return None
+
+
+def described_types(description, sources=None):
+    # arrow types of the output columns from the query's cursor.description: sources[i] is the index of the
+    # query column output column i is copied from, None for computed ones (every query column when not given)
+    if sources is None:
+        sources = range(len(description))
+    return [None if index is None else column_type(description[index][1]) for index in sources]
+
+
+def unpivot_types(unpivot, types):
+    # types of the long layout columns from those of the wide ones
+    long_types = [types[index] for index in unpivot.id_indexes]
+    long_types += [pyarrow.timestamp('us'), pyarrow.timestamp('us')]
+    for _, indexes in unpivot.measure_fields:
+        long_types.append(next((types[index] for index in indexes if types[index] is not None), None))
+    return long_types
+
+
+def infer_type(column):
+    # columns without a known type (computed ones): numbers are stored as float64, so that a fraction
+    # in a later batch is not truncated, as are columns without any value in the first batch
+    column_type = pyarrow.array(column).type
+    if pyarrow.types.is_null(column_type) or pyarrow.types.is_integer(column_type):
+        return pyarrow.float64()
+    return column_type
+
+
+def make_schema(header, columns, types):
+    return pyarrow.schema([
+        pyarrow.field(name, infer_type(column) if column_type is None else column_type)
+        for name, column, column_type in itertools.zip_longest(header, columns, types[:len(header)])
+    ])
+
+
+def record_batch(header, rows, schema=None, types=()):
+    columns = list(zip(*rows))
+    if schema is None:
+        schema = make_schema(header, columns, list(types))
+    arrays = [pyarrow.array(column, type=field.type) for column, field in zip(columns, schema)]
+    return pyarrow.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def open_writer(export_format, sink, schema):
+    if export_format == 'parquet':
+        return pyarrow.parquet.ParquetWriter(pyarrow.PythonFile(sink, mode='w'), schema)
+    return pyarrow.ipc.new_stream(pyarrow.PythonFile(sink, mode='w'), schema)
+
+
+def write_batch(export_format, writer, batch):
+    if export_format == 'parquet':
+        writer.write_table(pyarrow.Table.from_batches([batch]))
+    else:
+        writer.write_batch(batch)
+
+
+class ColumnarEncoder:
+    # One file is written across all batches, they are encoded one after the other
+    stateful = True
+
+    def __init__(self, export_format, header, projection=None, unpivot=None, types=None):
+        # types: function returning the arrow types (None: inferred) of the columns of header, called once
+        # the first rows are read, see described_types()
+        self.export_format = export_format
+        self.header = header if unpivot is None else unpivot.header
+        self.projection = projection
+        self.unpivot = unpivot
+        self.types = types
+        self.sink = _Sink()
+        self.schema = None
+        self.writer = None
+
+    def start(self):
+        return b''
+
+    def encode(self, batch):
+        # batch: raw rows, sequences ordered like header once projected
+        if self.projection is not None:
+            batch = [self.projection(row) for row in batch]
+        if self.unpivot is not None:
+            batch = self.unpivot(batch)
+            if not batch:
+                return b''
+        types = ()
+        if self.schema is None and self.types is not None:
+            types = self.types()
+            if self.unpivot is not None:
+                types = unpivot_types(self.unpivot, types)
+        record = record_batch(self.header, batch, self.schema, types)
+        if self.writer is None:
+            self.schema = record.schema
+            self.writer = open_writer(self.export_format, self.sink, self.schema)
+        write_batch(self.export_format, self.writer, record)
+        return self.sink.drain()
+
+    def finish(self):
+        if self.writer is None:
+            # no rows at all, the file still carries the columns (as strings when their type is not known)
+            types = [] if self.types is None else self.types()
+            if types and self.unpivot is not None:
+                types = unpivot_types(self.unpivot, types)
+            self.schema = pyarrow.schema([
+                pyarrow.field(name, column_type or pyarrow.string())
+                for name, column_type in itertools.zip_longest(self.header, types[:len(self.header)])
+            ])
+            self.writer = open_writer(self.export_format, self.sink, self.schema)
+        self.writer.close()
+        return self.sink.drain()
@@ -0,0 +1,75 @@
+import asyncio
+import zlib
+
+from server.utility import config
+
+# zlib level used for gzip/deflate responses
+COMPRESSION_LEVEL = 6
+# Chunks of at least this many bytes are compressed in the default executor instead of on the event loop, 0 = never
+COMPRESSION_EXECUTOR_THRESHOLD = 16 * 1024
+# Smaller JSON bodies are sent uncompressed
+COMPRESSION_MIN_SIZE = 1024
+
+__WBITS = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS,
+}
+
+
+def negotiate(request):
+    # Preferred encoding of the Accept-Encoding header, None for identity
+    accepted = {}
+    for item in request.headers.get('Accept-Encoding', '').split(','):
+        encoding, *parameters = [part.strip() for part in item.split(';')]
+        quality = 1.0
+        for parameter in parameters:
+            if parameter.startswith('q='):
+                try:
+                    quality = float(parameter[2:])
+                except ValueError:
+                    quality = 0.0
+        accepted[encoding.lower()] = quality
+
+    candidates = [
+        (accepted.get(encoding, accepted.get('*', 0.0)), encoding)
+        for encoding in __WBITS
+    ]
+    quality, encoding = max(candidates, key=lambda candidate: candidate[0])
+    return encoding if quality > 0 else None
+
+
+def compressor(app, encoding):
+    level = int(config(app, 'COMPRESSION_LEVEL', COMPRESSION_LEVEL))
+    return zlib.compressobj(level, zlib.DEFLATED, __WBITS[encoding])
+
+
+async def compress_chunks(app, encoding, chunks):
+    # Every chunk is sync-flushed, so the client receives data as soon as it is produced
+    compress = compressor(app, encoding)
+    threshold = int(config(app, 'COMPRESSION_EXECUTOR_THRESHOLD', COMPRESSION_EXECUTOR_THRESHOLD))
+    loop = asyncio.get_event_loop()
+
+    def compress_chunk(chunk):
+        return compress.compress(chunk) + compress.flush(zlib.Z_SYNC_FLUSH)
+
+    try:
+        async for chunk in chunks:
+            if threshold and len(chunk) >= threshold:
+                yield await loop.run_in_executor(None, compress_chunk, chunk)
+            else:
+                yield compress_chunk(chunk)
+    finally:
+        await chunks.aclose()
+    yield compress.flush()
+
+
+async def compress_body(app, encoding, body):
+    compress = compressor(app, encoding)
+    threshold = int(config(app, 'COMPRESSION_EXECUTOR_THRESHOLD', COMPRESSION_EXECUTOR_THRESHOLD))
+
+    def compress_all():
+        return compress.compress(body) + compress.flush()
+
+    if threshold and len(body) >= threshold:
+        return await asyncio.get_event_loop().run_in_executor(None, compress_all)
+    return compress_all()
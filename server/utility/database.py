@@ -1,33 +1,697 @@
+import asyncio
+import collections
+import concurrent.futures
+import datetime
+import hashlib
+import itertools
+import logging
+import re
+import threading
+import time
+import weakref
+
 import aiopg
+import psycopg2
 import aiohttp.web
-from server.utility import config
+from server.utility import config, metrics
+
+logger = logging.getLogger(__name__)
+
+# Pool settings, read as <OPENMETRICS|LOCAL_STORAGE>_<name>
+POOL_DEFAULTS = {
+    'POOL_MINSIZE': 1,
+    'POOL_MAXSIZE': 10,
+    'POOL_ACQUIRE_TIMEOUT': 0,  # seconds to wait for a free connection, 0 waits forever
+    'POOL_RECYCLE': 0,  # seconds after which idle connections are reopened, 0 keeps them
+    'STATEMENT_TIMEOUT': 0,  # milliseconds, 0 leaves the server default
+}
+
+
+def pool_setting(app: aiohttp.web.Application, prefix, name):
+    return config(app, f'{prefix}_{name}', POOL_DEFAULTS[name])
+
+
+__STATISTICS = '_STATISTICS'
+__ACQUIRE_TIMEOUT = '_ACQUIRE_TIMEOUT'
+__QUERY_LOG = '_QUERY_LOG'
+
+# Statements taking at least this many seconds are logged and explained, 0 disables it
+SLOW_QUERY_THRESHOLD = 1.0
+# Seconds between two EXPLAIN of the same statement fingerprint
+SLOW_QUERY_EXPLAIN_INTERVAL = 3600
+# EXPLAIN (ANALYZE, BUFFERS) executes the statement a second time, long exports included
+SLOW_QUERY_EXPLAIN_ANALYZE = False
+# Fingerprints with statistics kept per pool, the least recently executed are dropped first
+QUERY_STATS_SIZE = 500
+
+__COMMENTS = re.compile(r'--[^\n]*|/\*.*?\*/', re.DOTALL)
+__LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+__WHITESPACE = re.compile(r'\s+')
+
+
+def normalize_query(query):
+    query = __COMMENTS.sub(' ', query)
+    query = __LITERALS.sub('?', query)
+    return __WHITESPACE.sub(' ', query).strip().rstrip(';').strip()
+
+
+def fingerprint(query):
+    return hashlib.sha1(normalize_query(query).encode()).hexdigest()[:16]
+
+
+def parameter_types(parameters):
+    # What is logged of the parameters of a statement: their values may be credentials
+    def value_type(value):
+        if isinstance(value, (list, tuple)):
+            return f'{type(value).__name__}[{len(value)}]'
+        return type(value).__name__
+
+    if isinstance(parameters, dict):
+        return {name: value_type(value) for name, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [value_type(value) for value in parameters]
+    return value_type(parameters)
+
+
+class QueryStatistics:
+    def __init__(self, query):
+        self.query = normalize_query(query)
+        self.calls = 0
+        self.rows = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.slow_calls = 0
+        self.explained = None  # time of the last EXPLAIN
+
+
+class QueryLog:
+    # Per pool statistics by statement fingerprint. Slow SELECTs are explained in the background
+    # (with ANALYZE, BUFFERS when analyze is set), the plans are appended to SLOW_QUERY_LOG
+    def __init__(self, pool_name, connection_pool: aiopg.Pool, threshold, explain_interval, log_path, size,
+                 analyze=False):
+        self.pool_name = pool_name
+        self.connection_pool = connection_pool
+        self.threshold = threshold
+        self.explain_interval = explain_interval
+        self.analyze = analyze
+        self.log_path = log_path
+        self.size = size
+        self.statistics = collections.OrderedDict()  # fingerprint -> QueryStatistics
+        self.explaining = None
+
+    def record(self, query, parameters, rows, seconds):
+        key = fingerprint(query)
+        statistics = self.statistics.get(key)
+        if statistics is None:
+            statistics = self.statistics[key] = QueryStatistics(query)
+            if len(self.statistics) > self.size:
+                self.statistics.popitem(last=False)
+        else:
+            self.statistics.move_to_end(key)
+        statistics.calls += 1
+        statistics.rows += max(rows, 0)
+        statistics.seconds += seconds
+        statistics.max_seconds = max(statistics.max_seconds, seconds)
+        logger.debug(f'{self.pool_name} query {key}: {rows} rows in {seconds:.3f}s')
+
+        if not self.threshold or seconds < self.threshold:
+            return
+        statistics.slow_calls += 1
+        logger.warning(f'Slow {self.pool_name} query {key}: {rows} rows in {seconds:.3f}s')
+        now = time.monotonic()
+        if statistics.query.lower().startswith('select') \
+                and (statistics.explained is None or now - statistics.explained >= self.explain_interval) \
+                and (self.explaining is None or self.explaining.done()):
+            # one at a time, read only: EXPLAIN ANALYZE executes the statement again
+            statistics.explained = now
+            self.explaining = asyncio.ensure_future(self.explain(key, query, parameters, rows, seconds))
+
+    async def explain(self, key, query, parameters, rows, seconds):
+        try:
+            async with self.connection_pool.acquire() as connection:
+                async with connection.cursor() as cursor:
+                    await cursor.execute('BEGIN READ ONLY')
+                    try:
+                        explain = 'EXPLAIN (ANALYZE, BUFFERS) ' if self.analyze else 'EXPLAIN '
+                        await cursor.execute(explain + strip_statement_end(query), parameters)
+                        plan = [line for line, in await cursor.fetchall()]
+                    finally:
+                        await cursor.execute('ROLLBACK')
+        except Exception:
+            logger.exception(f'Failed to explain {self.pool_name} query {key}')
+            return
+
+        entry = '\n'.join([
+            f'-- {datetime.datetime.now().isoformat()} {self.pool_name} query {key}: {rows} rows in {seconds:.3f}s',
+            normalize_query(query) + ';',
+            f'-- parameters: {parameter_types(parameters)!r}',
+            *plan,
+            '',
+        ])
+        if self.log_path:
+            with open(self.log_path, 'a') as log_file:
+                log_file.write(entry + '\n')
+        else:
+            logger.warning(entry)
+
+    async def close(self):
+        if self.explaining is not None and not self.explaining.done():
+            self.explaining.cancel()
+            await asyncio.gather(self.explaining, return_exceptions=True)
 
+    def stats(self):
+        return [
+            {
+                'fingerprint': key,
+                'query': statistics.query,
+                'calls': statistics.calls,
+                'rows': statistics.rows,
+                'seconds_total': statistics.seconds,
+                'seconds_max': statistics.max_seconds,
+                'slow_calls': statistics.slow_calls,
+            }
+            for key, statistics in sorted(self.statistics.items(), key=lambda item: -item[1].seconds)
+        ]
 
-def __create_database_context(resource_name, config_key):
+
+# aiopg connection -> QueryLog of its pool, set when it is acquired
+_connection_query_logs = weakref.WeakKeyDictionary()
+
+
+class PoolStatistics:
+    def __init__(self):
+        self.acquired = 0
+        self.waiting = 0
+        self.acquisitions = 0
+        self.timeouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+
+class _Acquire:
+    # Counting replacement of "pool.acquire()" for "async with"
+    def __init__(self, connection_pool: aiopg.Pool, statistics: PoolStatistics, timeout, query_log: QueryLog):
+        self.connection_pool = connection_pool
+        self.statistics = statistics
+        self.timeout = timeout
+        self.query_log = query_log
+        self.connection = None
+
+    async def __aenter__(self) -> aiopg.Connection:
+        statistics = self.statistics
+        statistics.waiting += 1
+        started = time.monotonic()
+        try:
+            if self.timeout:
+                self.connection = await asyncio.wait_for(self.connection_pool.acquire(), self.timeout)
+            else:
+                self.connection = await self.connection_pool.acquire()
+        except asyncio.TimeoutError:
+            statistics.timeouts += 1
+            raise
+        finally:
+            statistics.waiting -= 1
+        waited = time.monotonic() - started
+        statistics.acquired += 1
+        statistics.acquisitions += 1
+        statistics.wait_seconds += waited
+        statistics.max_wait_seconds = max(statistics.max_wait_seconds, waited)
+        _connection_query_logs[self.connection] = self.query_log
+        return self.connection
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.statistics.acquired -= 1
+        await self.connection_pool.release(self.connection)
+
+
+async def __prewarm(connection_pool: aiopg.Pool):
+    # Open minsize connections up front and fail at startup when the database is unreachable
+    async def check(connection):
+        async with connection.cursor() as cursor:
+            await cursor.execute('SELECT 1')
+
+    connections = [await connection_pool.acquire() for _ in range(connection_pool.minsize)]
+    try:
+        await asyncio.gather(*[check(connection) for connection in connections])
+    finally:
+        for connection in connections:
+            await connection_pool.release(connection)
+
+
+def __create_database_context(resource_name, prefix, slow_queries=True):
+    # slow_queries: whether slow statements are logged and explained, statistics are always kept
     async def cleanup_context(app: aiohttp.web.Application):
+        pool_options = {
+            'minsize': int(pool_setting(app, prefix, 'POOL_MINSIZE')),
+            'maxsize': int(pool_setting(app, prefix, 'POOL_MAXSIZE')),
+        }
+        pool_recycle = float(pool_setting(app, prefix, 'POOL_RECYCLE'))
+        if pool_recycle > 0:
+            pool_options['pool_recycle'] = pool_recycle
+        statement_timeout = int(pool_setting(app, prefix, 'STATEMENT_TIMEOUT'))
+        if statement_timeout > 0:
+            pool_options['options'] = f'-c statement_timeout={statement_timeout}'
+
         # Create postgres connection pool and append it to application
-        async with aiopg.create_pool(config(app, config_key)) as connection_pool:
+        async with aiopg.create_pool(config(app, f'{prefix}_DSN'), **pool_options) as connection_pool:
+            await __prewarm(connection_pool)
             app[resource_name] = connection_pool
+            app[resource_name + __STATISTICS] = PoolStatistics()
+            app[resource_name + __ACQUIRE_TIMEOUT] = float(pool_setting(app, prefix, 'POOL_ACQUIRE_TIMEOUT'))
+            app[resource_name + __QUERY_LOG] = query_log = QueryLog(
+                prefix.lower(), connection_pool,
+                threshold=float(config(app, 'SLOW_QUERY_THRESHOLD', SLOW_QUERY_THRESHOLD)) if slow_queries else 0,
+                explain_interval=float(config(app, 'SLOW_QUERY_EXPLAIN_INTERVAL', SLOW_QUERY_EXPLAIN_INTERVAL)),
+                log_path=config(app, 'SLOW_QUERY_LOG', None),
+                size=int(config(app, 'QUERY_STATS_SIZE', QUERY_STATS_SIZE)),
+                analyze=str(config(app, 'SLOW_QUERY_EXPLAIN_ANALYZE', SLOW_QUERY_EXPLAIN_ANALYZE)).lower()
+                in ('1', 'true', 'yes'),
+            )
             yield  # <!> Do not remove this yield
+            await query_log.close()
 
     return cleanup_context
 
 
+def __acquire(app: aiohttp.web.Application, resource_name):
+    assert resource_name in app
+    return _Acquire(
+        app[resource_name], app[resource_name + __STATISTICS], app[resource_name + __ACQUIRE_TIMEOUT],
+        app[resource_name + __QUERY_LOG]
+    )
+
+
+def __pool_stats(app: aiohttp.web.Application, resource_name):
+    connection_pool: aiopg.Pool = app[resource_name]
+    statistics: PoolStatistics = app[resource_name + __STATISTICS]
+    return {
+        'size': connection_pool.size,
+        'minsize': connection_pool.minsize,
+        'maxsize': connection_pool.maxsize,
+        'idle': connection_pool.freesize,
+        'acquired': statistics.acquired,
+        'waiting': statistics.waiting,
+        'acquisitions': statistics.acquisitions,
+        'timeouts': statistics.timeouts,
+        'wait_seconds_total': statistics.wait_seconds,
+        'wait_seconds_max': statistics.max_wait_seconds,
+    }
+
+
 __OPENMETRICS_DB_POOL = 'OPENMETRICS_DB_POOL'
-openmetrics_ctx = __create_database_context(__OPENMETRICS_DB_POOL, 'OPENMETRICS_DSN')
+openmetrics_ctx = __create_database_context(__OPENMETRICS_DB_POOL, 'OPENMETRICS')
 
 
 def openmetrics(app: aiohttp.web.Application):
-    assert __OPENMETRICS_DB_POOL in app
-    connection_pool: aiopg.Pool = app[__OPENMETRICS_DB_POOL]
-    return connection_pool.acquire()
+    return __acquire(app, __OPENMETRICS_DB_POOL)
 
 
 __LOCAL_STORAGE_DB_POOL = 'LOCAL_STORAGE_DB_POOL'
-local_storage_ctx = __create_database_context(__LOCAL_STORAGE_DB_POOL, 'LOCAL_STORAGE_DSN')
+# Its statements carry api keys and passwords: they are counted, never logged or explained
+local_storage_ctx = __create_database_context(__LOCAL_STORAGE_DB_POOL, 'LOCAL_STORAGE', slow_queries=False)
+
+
+def local_storage(app: aiohttp.web.Application):
+    return __acquire(app, __LOCAL_STORAGE_DB_POOL)
+
+
+__LISTEN_CHECK_INTERVAL = 60
+__LISTEN_RETRY_DELAY = 5
+
+
+async def listen(dsn, channel, invalidate):
+    # Calls invalidate(payload) for every NOTIFY on channel, and invalidate(None) after (re)connecting:
+    # notifications could be missed in the meantime. Runs until cancelled.
+    while True:
+        try:
+            async with aiopg.connect(dsn) as conn:
+                async with conn.cursor() as cursor:
+                    await cursor.execute(f'LISTEN {channel}')
+                    invalidate(None)
+                    while True:
+                        notify = asyncio.ensure_future(conn.notifies.get())
+                        try:
+                            done, _ = await asyncio.wait([notify], timeout=__LISTEN_CHECK_INTERVAL)
+                        except asyncio.CancelledError:
+                            notify.cancel()
+                            raise
+                        if not done:
+                            notify.cancel()
+                            # a dropped connection does not wake up notifies.get()
+                            await cursor.execute('SELECT 1')
+                            continue
+                        invalidate(notify.result().payload)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception(f'LISTEN {channel} failed, retrying in {__LISTEN_RETRY_DELAY}s')
+            await asyncio.sleep(__LISTEN_RETRY_DELAY)
+
+
+def pool_stats(app: aiohttp.web.Application):
+    stats = {
+        'openmetrics': __pool_stats(app, __OPENMETRICS_DB_POOL),
+        'local_storage': __pool_stats(app, __LOCAL_STORAGE_DB_POOL),
+    }
+    if copy_available(app):
+        stats['openmetrics_copy'] = app[__OPENMETRICS_COPY_POOL].stats()
+    return stats
+
+
+def query_stats(app: aiohttp.web.Application):
+    return {
+        'openmetrics': app[__OPENMETRICS_DB_POOL + __QUERY_LOG].stats(),
+        'local_storage': app[__LOCAL_STORAGE_DB_POOL + __QUERY_LOG].stats(),
+    }
+
+
+def record_query(connection: aiopg.Connection, query, parameters, rows, seconds):
+    query_log = _connection_query_logs.get(connection)
+    if query_log is not None:
+        query_log.record(query, parameters, rows, seconds)
+
+
+# Rows fetched from a server-side cursor per round trip
+OPENMETRICS_ITERSIZE = 2000
+
+__CURSOR_NAMES = itertools.count()
+__STATEMENT_END = re.compile(r';\s*(--[^\n]*)?\s*$')
+
+
+def strip_statement_end(query):
+    # the query without its final ";" (and trailing comment), to be embedded in another statement
+    return __STATEMENT_END.sub('', query.strip())
+
+
+def itersize(app: aiohttp.web.Application):
+    return int(config(app, 'OPENMETRICS_ITERSIZE', OPENMETRICS_ITERSIZE))
+
+
+async def timed_execute(cursor, query, parameters=None):
+    started = time.monotonic()
+    try:
+        await cursor.execute(query, parameters)
+    finally:
+        seconds = time.monotonic() - started
+        metrics.DB_QUERY_DURATION.observe(seconds)
+    return seconds
+
+
+async def execute(cursor, query, parameters=None):
+    seconds = await timed_execute(cursor, query, parameters)
+    record_query(cursor.connection, query, parameters, cursor.rowcount, seconds)
+
+
+async def server_cursor(connection: aiopg.Connection, query, parameters=None, itersize=OPENMETRICS_ITERSIZE,
+                        description=None):
+    # psycopg2 refuses named cursors on asynchronous connections, so the cursor is declared
+    # by hand inside a read only transaction and rows are fetched in batches of "itersize".
+    # description (a list) receives the (name, type_code) of the columns with the first batch.
+    cursor_name = f'api_cursor_{next(__CURSOR_NAMES)}'
+    declare_query = f'DECLARE {cursor_name} NO SCROLL CURSOR FOR ' + strip_statement_end(query)
+    fetch_query = f'FETCH FORWARD {int(itersize)} FROM {cursor_name}'
+
+    # recorded as one statement: time spent in the database, all rows fetched
+    seconds = 0.0
+    row_count = 0
+    async with connection.cursor() as cursor:
+        await cursor.execute('BEGIN READ ONLY')
+        try:
+            seconds += await timed_execute(cursor, declare_query, parameters)
+            while True:
+                seconds += await timed_execute(cursor, fetch_query)
+                describe(description, cursor)
+                rows = await cursor.fetchall()
+                row_count += len(rows)
+                for row in rows:
+                    yield row
+                if len(rows) < itersize:
+                    break
+        finally:
+            record_query(connection, query, parameters, row_count, seconds)
+            # Closes the cursor too, the connection goes back to the pool outside of a transaction
+            if not connection.closed:
+                await cursor.execute('ROLLBACK')
+
+
+def describe(description, cursor):
+    if description is not None and not description and cursor.description:
+        description.extend((column.name, column.type_code) for column in cursor.description)
+
+
+async def openmetrics_rows(app: aiohttp.web.Application, query, parameters=None, server_side=True, description=None):
+    async with openmetrics(app) as connection:
+        if not server_side:
+            # one round trip, the whole result is fetched at once: only for small results
+            async with connection.cursor() as cursor:
+                await execute(cursor, query, parameters)
+                describe(description, cursor)
+                async for row in cursor:
+                    yield row
+            return
+
+        rows = server_cursor(connection, query, parameters, itersize=itersize(app), description=description)
+        try:
+            async for row in rows:
+                yield row
+        finally:
+            # roll back before the connection is released, even when the consumer stops early
+            await rows.aclose()
+
+
+# COPY ... TO STDOUT exports. aiopg can not copy, so plain psycopg2 connections run it in threads
+# and hand the bytes over to the event loop
+COPY_EXPORTS = True
+# psycopg2 connections copying at once, on top of the OPENMETRICS pool
+COPY_POOL_MAXSIZE = 2
+# Chunks of one COPY buffered ahead of the client
+COPY_MAX_PENDING = 4
+
+__OPENMETRICS_COPY_POOL = 'OPENMETRICS_COPY_POOL'
+
+
+class CopyCancelled(Exception):
+    pass
+
+
+class CopyPool:
+    # Read only psycopg2 connections, at most maxsize of them copying at once
+    def __init__(self, dsn, maxsize, options, acquire_timeout=0):
+        self.dsn = dsn
+        self.maxsize = maxsize
+        self.options = options
+        self.acquire_timeout = acquire_timeout
+        self.idle = []
+        self.slots = asyncio.Semaphore(maxsize)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=maxsize, thread_name_prefix='copy')
+        self.statistics = PoolStatistics()
+        self.rows = 0
+
+    async def acquire(self):
+        # A copy slot, counted like a connection of the aiopg pools
+        statistics = self.statistics
+        statistics.waiting += 1
+        started = time.monotonic()
+        try:
+            if self.acquire_timeout:
+                await asyncio.wait_for(self.slots.acquire(), self.acquire_timeout)
+            else:
+                await self.slots.acquire()
+        except asyncio.TimeoutError:
+            statistics.timeouts += 1
+            raise
+        finally:
+            statistics.waiting -= 1
+        waited = time.monotonic() - started
+        statistics.acquired += 1
+        statistics.acquisitions += 1
+        statistics.wait_seconds += waited
+        statistics.max_wait_seconds = max(statistics.max_wait_seconds, waited)
+
+    def release(self):
+        self.statistics.acquired -= 1
+        self.slots.release()
+
+    def stats(self):
+        statistics = self.statistics
+        return {
+            'size': len(self.idle) + statistics.acquired,
+            'minsize': 0,
+            'maxsize': self.maxsize,
+            'idle': len(self.idle),
+            'acquired': statistics.acquired,
+            'waiting': statistics.waiting,
+            'acquisitions': statistics.acquisitions,
+            'timeouts': statistics.timeouts,
+            'wait_seconds_total': statistics.wait_seconds,
+            'wait_seconds_max': statistics.max_wait_seconds,
+            'rows': self.rows,
+        }
+
+    def getconn(self) -> psycopg2.extensions.connection:
+        try:
+            return self.idle.pop()
+        except IndexError:
+            connection = psycopg2.connect(self.dsn, options=self.options)
+            connection.set_session(readonly=True)
+            return connection
+
+    def putconn(self, connection, discard=False):
+        if not discard and not connection.closed:
+            try:
+                connection.rollback()
+                self.idle.append(connection)
+                return
+            except psycopg2.Error:
+                pass
+        connection.close()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        while self.idle:
+            self.idle.pop().close()
+
+
+async def openmetrics_copy_ctx(app: aiohttp.web.Application):
+    enabled = str(config(app, 'COPY_EXPORTS', COPY_EXPORTS)).lower() not in ('0', 'false', 'no')
+    if enabled:
+        options = '-c DateStyle=ISO'
+        statement_timeout = int(pool_setting(app, 'OPENMETRICS', 'STATEMENT_TIMEOUT'))
+        if statement_timeout > 0:
+            options += f' -c statement_timeout={statement_timeout}'
+        app[__OPENMETRICS_COPY_POOL] = CopyPool(
+            config(app, 'OPENMETRICS_DSN'), int(config(app, 'COPY_POOL_MAXSIZE', COPY_POOL_MAXSIZE)), options,
+            acquire_timeout=float(pool_setting(app, 'OPENMETRICS', 'POOL_ACQUIRE_TIMEOUT'))
+        )
+    yield  # <!> Do not remove this yield
+    if enabled:
+        app[__OPENMETRICS_COPY_POOL].close()
+
+
+def copy_available(app: aiohttp.web.Application):
+    return __OPENMETRICS_COPY_POOL in app
+
+
+class _CopyWriter:
+    # File object for copy_expert: collects the rows Postgres sends into chunks and passes them to the loop,
+    # blocking the copying thread while the client is COPY_MAX_PENDING chunks behind
+    def __init__(self, loop, chunks: asyncio.Queue, chunk_size, max_pending, header=True):
+        self.loop = loop
+        self.chunks = chunks
+        self.chunk_size = chunk_size
+        self.buffer = bytearray()
+        self.free = threading.Semaphore(max_pending)
+        self.cancelled = threading.Event()
+        self.messages = 0  # one per row, plus the header if any
+        self.buffered_rows = -int(header)
+        self.blocked_seconds = 0.0
+        self.seconds = 0.0
+
+    def write(self, data):
+        self.messages += 1
+        self.buffered_rows += 1
+        self.buffer += data
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            # (chunk, rows in it)
+            self.put((bytes(self.buffer), self.buffered_rows))
+            self.buffer.clear()
+            self.buffered_rows = 0
+
+    def put(self, item):
+        started = time.monotonic()
+        self.free.acquire()
+        self.blocked_seconds += time.monotonic() - started
+        if self.cancelled.is_set():
+            raise CopyCancelled()
+        self.loop.call_soon_threadsafe(self.chunks.put_nowait, item)
+
+    def cancel(self):
+        self.cancelled.set()
+        self.free.release()
+
+
+async def openmetrics_copy(app: aiohttp.web.Application, query, parameters=None, chunk_size=64 * 1024, header=True,
+                           handler=None):
+    # Bytes of "COPY (query) TO STDOUT WITH (FORMAT csv, HEADER)", the header comes from the column names
+    # (without it when header is False: the following parts of a sharded export).
+    # Rows sent are counted in ROWS_STREAMED under handler, when given
+    copy_pool: CopyPool = app[__OPENMETRICS_COPY_POOL]
+    loop = asyncio.get_event_loop()
+    chunks = asyncio.Queue()
+    writer = _CopyWriter(
+        loop, chunks, chunk_size, int(config(app, 'COPY_MAX_PENDING', COPY_MAX_PENDING)), header
+    )
+    copying_connections = []
+    lock = threading.Lock()
 
+    def copy():
+        connection = copy_pool.getconn()
+        discard = False
+        try:
+            with connection.cursor() as cursor:
+                select_query = cursor.mogrify(strip_statement_end(query), parameters).decode()
+                started = time.monotonic()
+                copy_options = 'FORMAT csv, HEADER' if header else 'FORMAT csv'
+                # listed (so the loop may cancel it) only while the COPY runs
+                with lock:
+                    copying_connections.append(connection)
+                try:
+                    cursor.copy_expert(f'COPY ({select_query}) TO STDOUT WITH ({copy_options})', writer)
+                except BaseException:
+                    discard = True
+                    raise
+                finally:
+                    with lock:
+                        if connection in copying_connections:
+                            copying_connections.remove(connection)
+                        else:
+                            # cancelled by the loop, the request may reach the server after the COPY
+                            discard = True
+                writer.seconds = time.monotonic() - started - writer.blocked_seconds
+            writer.flush()
+            writer.put(None)
+        except CopyCancelled:
+            pass
+        except BaseException as exception:
+            if not writer.cancelled.is_set():
+                writer.put(exception)
+        finally:
+            copy_pool.putconn(connection, discard=discard)
 
-def local_storage(app: aiohttp.web.Application) -> aiopg.Connection:
-    assert __LOCAL_STORAGE_DB_POOL in app
-    connection_pool: aiopg.Pool = app[__LOCAL_STORAGE_DB_POOL]
-    return connection_pool.acquire()
+    await copy_pool.acquire()
+    try:
+        copying = loop.run_in_executor(copy_pool.executor, copy)
+        try:
+            while True:
+                item = await chunks.get()
+                writer.free.release()
+                if item is None:
+                    # time spent waiting for the client is not the query's
+                    app[__OPENMETRICS_DB_POOL + __QUERY_LOG].record(
+                        query, parameters, writer.messages - int(header), writer.seconds
+                    )
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                chunk, rows = item
+                copy_pool.rows += rows
+                if handler is not None:
+                    metrics.ROWS_STREAMED.inc(rows, handler=handler)
+                yield chunk
+        finally:
+            if not copying.done():
+                # the client went away: stop the server side and unblock the thread
+                writer.cancel()
+                with lock:
+                    while copying_connections:
+                        copying_connections.pop().cancel()
+                try:
+                    await copying
+                except Exception:
+                    pass
+    finally:
+        copy_pool.release()
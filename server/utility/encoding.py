@@ -0,0 +1,74 @@
+import asyncio
+import collections
+import concurrent.futures
+
+from aiohttp import web
+
+from server.utility import config
+
+# Threads encoding export rows to bytes, 0 encodes on the event loop
+ENCODER_WORKERS = 2
+# Raw rows handed to a worker at once
+ENCODER_BATCH_SIZE = 2000
+# Batches of one response being encoded ahead of the client
+ENCODER_MAX_PENDING = 2
+
+__ENCODER_EXECUTOR = 'ENCODER_EXECUTOR'
+
+
+async def encoder_ctx(app: web.Application):
+    workers = int(config(app, 'ENCODER_WORKERS', ENCODER_WORKERS))
+    if workers > 0:
+        app[__ENCODER_EXECUTOR] = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='encoder'
+        )
+    yield  # <!> Do not remove this yield
+    if workers > 0:
+        app[__ENCODER_EXECUTOR].shutdown(wait=True)
+
+
+def batch_size(app: web.Application):
+    return int(config(app, 'ENCODER_BATCH_SIZE', ENCODER_BATCH_SIZE))
+
+
+async def batches(rows, size):
+    batch = []
+    try:
+        async for row in rows:
+            batch.append(row)
+            if len(batch) >= size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+    finally:
+        await rows.aclose()
+
+
+async def encoded_chunks(app: web.Application, encoder, rows, size=None):
+    # encoder: start() -> bytes, encode(batch) -> bytes, finish() -> bytes.
+    # Batches are encoded by the worker threads while the next ones are fetched, chunks come out in order.
+    # Stateful encoders (one file being written) get one batch in flight, they must not run concurrently.
+    executor = app.get(__ENCODER_EXECUTOR)
+    max_pending = 1 if encoder.stateful else int(config(app, 'ENCODER_MAX_PENDING', ENCODER_MAX_PENDING))
+    loop = asyncio.get_event_loop()
+    pending = collections.deque()
+
+    header = encoder.start()
+    if header:
+        yield header
+    try:
+        async for batch in batches(rows, size or batch_size(app)):
+            if executor is None:
+                yield encoder.encode(batch)
+                continue
+            while len(pending) >= max_pending:
+                yield await pending.popleft()
+            pending.append(loop.run_in_executor(executor, encoder.encode, batch))
+        while pending:
+            yield await pending.popleft()
+    finally:
+        # the client went away: batches not started yet are dropped
+        for future in pending:
+            future.cancel()
+    yield encoder.finish()
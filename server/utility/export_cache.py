@@ -0,0 +1,166 @@
+import collections
+import datetime
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+
+from aiohttp import web
+
+from server.utility import config
+
+logger = logging.getLogger(__name__)
+
+# Finished exports are kept on disk when EXPORT_CACHE_DIR is configured
+EXPORT_CACHE_SIZE = 1024 ** 3
+# Seconds an export whose range reaches today stays valid, 0 disables caching of such exports
+EXPORT_CACHE_TODAY_TTL = 0
+
+__EXPORT_CACHE = 'EXPORT_CACHE'
+
+# "<key>-<expires at><suffix>" and the ".<key>-<id>.tmp" of interrupted writes, other entries are left alone
+CACHE_FILE = re.compile(r'([0-9a-f]{64})-([0-9]+)(\.[0-9a-z]+)?')
+TEMPORARY_FILE = re.compile(r'\.[0-9a-f]{64}-[0-9]+\.tmp')
+
+
+class ExportCache:
+    # Cached files are named "<key>-<expires at, 0 = never><suffix>" so the index survives restarts
+    def __init__(self, directory, max_size, today_ttl):
+        self.directory = directory
+        self.max_size = max_size
+        self.today_ttl = today_ttl
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.__files = collections.OrderedDict()  # key -> (path, size, expires_at)
+
+        os.makedirs(directory, exist_ok=True)
+        cached = []
+        for entry in os.scandir(directory):
+            if not entry.is_file(follow_symlinks=False):
+                continue
+            if TEMPORARY_FILE.fullmatch(entry.name):
+                os.remove(entry.path)  # leftovers of interrupted writes
+                continue
+            match = CACHE_FILE.fullmatch(entry.name)
+            if match is not None:
+                stat = entry.stat(follow_symlinks=False)
+                cached.append((stat.st_atime, match.group(1), entry.path, stat.st_size, int(match.group(2))))
+        for _, key, path, size, expires_at in sorted(cached):
+            self.__add(key, path, size, expires_at)
+        self.__evict()
+
+    def lookup(self, key):
+        try:
+            path, size, expires_at = self.__files[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        if expires_at and expires_at <= time.time():
+            self.__remove(key)
+            self.misses += 1
+            return None
+        self.__files.move_to_end(key)
+        self.hits += 1
+        return path
+
+    async def store(self, key, suffix, ttl, chunks):
+        # Pass chunks through while writing them to disk, the file is published only once complete
+        expires_at = int(time.time() + ttl) if ttl else 0
+        path = os.path.join(self.directory, f'{key}-{expires_at}{suffix}')
+        temporary_path = os.path.join(self.directory, f'.{key}-{id(chunks)}.tmp')
+        complete = False
+        try:
+            with open(temporary_path, 'wb') as cache_file:
+                async for chunk in chunks:
+                    cache_file.write(chunk)
+                    yield chunk
+            complete = True
+        finally:
+            if complete:
+                if key in self.__files:
+                    self.__remove(key)
+                os.replace(temporary_path, path)
+                self.__add(key, path, os.path.getsize(path), expires_at)
+                self.__evict()
+            else:
+                os.remove(temporary_path)
+
+    def __add(self, key, path, size, expires_at):
+        self.__files[key] = (path, size, expires_at)
+        self.size += size
+
+    def __remove(self, key):
+        path, size, _ = self.__files.pop(key)
+        self.size -= size
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def __evict(self):
+        while self.size > self.max_size and self.__files:
+            self.__remove(next(iter(self.__files)))
+
+
+async def export_cache_ctx(app: web.Application):
+    directory = config(app, 'EXPORT_CACHE_DIR', None)
+    if directory:
+        app[__EXPORT_CACHE] = ExportCache(
+            directory,
+            max_size=int(config(app, 'EXPORT_CACHE_SIZE', EXPORT_CACHE_SIZE)),
+            today_ttl=int(config(app, 'EXPORT_CACHE_TODAY_TTL', EXPORT_CACHE_TODAY_TTL)),
+        )
+    yield  # <!> Do not remove this yield
+
+
+def cache_key(handler_name, request_args, meter_ids=()):
+    # meter_ids: the meters the request resolved to, a cached file is not served any more once they change
+    normalized_args = {
+        name: sorted(value) if name == 'slugs' else value
+        for name, value in request_args.items()
+    }
+    return hashlib.sha256(
+        json.dumps([handler_name, normalized_args, sorted(meter_ids)], sort_keys=True).encode()
+    ).hexdigest()
+
+
+class Entry:
+    def __init__(self, export_cache, key, ttl):
+        self.export_cache = export_cache
+        self.key = key
+        self.ttl = ttl
+
+    def lookup(self):
+        return self.export_cache.lookup(self.key)
+
+    def store(self, suffix, chunks):
+        return self.export_cache.store(self.key, suffix, self.ttl, chunks)
+
+
+def get(app: web.Application):
+    # None when caching is disabled
+    return app.get(__EXPORT_CACHE)
+
+
+def entry(app: web.Application, handler_name, request_args, date_to, meter_ids):
+    # Cache entry of an export of the meter_ids meters, None when caching is disabled or the range is not finished yet
+    export_cache = get(app)
+    if export_cache is None:
+        return None
+
+    try:
+        last_day = datetime.datetime.strptime(str(date_to)[:10], '%Y-%m-%d').date()
+    except ValueError:
+        return None
+
+    if last_day < datetime.date.today():
+        ttl = 0
+    elif export_cache.today_ttl > 0:
+        ttl = export_cache.today_ttl
+    else:
+        return None
+
+    return Entry(export_cache, cache_key(handler_name, request_args, meter_ids), ttl)
@@ -1,7 +1,24 @@
-import datetime, io, csv
+import asyncio
+import datetime
+import operator
 from aiohttp import web
 
-from server.utility import database, tokens, config
+from server.utility import database, tokens, config, streaming, jobs, meter_access, unpivot, columnar
+
+
+# Requested meters: the user's (all of them for the superuser), narrowed by slugs and meter type
+# (users' meters come already narrowed from the meter access cache)
+meters_filter = """(%(all_users)s OR meter.id = ANY(%(meter_ids)s))
+         AND (%(empty_slugs)s OR meter.name IN %(slugs)s)
+         AND meter.type = %(type)s"""
+
+readings_query = """SELECT /*<select_names>*/*/*</select_names>*/ FROM readings_reading as reading
+         INNER JOIN meters_meter as meter ON meter.id = reading.meter_id
+         /*<readings_join>*/
+         WHERE /*<meters_filter>*/
+         AND %(date_from)s <= reading.date AND reading.date <= %(date_to)s
+         ORDER BY meter.id, reading.date
+        ;""".replace('/*<meters_filter>*/', meters_filter)
 
 
 def current_time():
@@ -15,7 +32,16 @@ class DefaultExporter:
     def meter_type(self):
         raise NotImplementedError
 
-    async def process_meter(self, meter):
+    # dict of column name -> select expression over "reading" (and tables added by readings_join)
+    def reading_fields(self):
+        raise NotImplementedError
+
+    # extra joins for reading_fields
+    def readings_join(self):
+        return ''
+
+    # dict of output field -> column name, or (function, *column names) for derived fields
+    def field_sources(self):
         raise NotImplementedError
 
     # get request username
@@ -46,72 +72,147 @@ class DefaultExporter:
     def fields(self):
         raise NotImplementedError
 
-    async def export(self, request, request_args):
+    # get request export format
+    def get_format(self):
+        return self.request_args.get('format', 'csv')
+
+    # get request layout: 'wide' (one row per meter and day) or 'long' (one row per half hour)
+    def get_layout(self):
+        return self.request_args.get('layout', 'wide')
+
+    def get_unpivot(self):
+        if self.get_layout() != 'long':
+            return None
+        return unpivot.Unpivot(self.get_fields())
+
+    # raw rows, the projection turning them into rows of the requested fields, applied by the encoder threads,
+    # and the column types of parquet/arrow exports
+    def export(self, request, request_args):
         self.request = request
         self.request_args = request_args
 
-        if self.get_username() == "_SUPERUSER":
-            meters = await self.get_meters(is_superuser=True)
-        else:
-            meters = await self.get_meters()
-
-        rows = list()
-        async for meter_elem in meters:
-            meter = Meter(meter_elem)
-            elements = await self.process_meter(meter)
-            for element in elements:
-                rows.append(element)
-
-        return self.make_csv(rows)
-
-    def make_csv(self, rows):
-        csv_response = io.StringIO()
-        writer = csv.DictWriter(csv_response, self.get_fields())
-        writer.writeheader()
-
-        for row in rows:
-            writer.writerow(row)
-            if csv_response.tell() > 4096 * 4096:
-                csv_response.seek(0)
-                yield csv_response.read()
-                csv_response.truncate()
-
-        if csv_response.tell() > 0:
-            csv_response.seek(0)
-            yield csv_response.read()
-
-    async def get_meters(self, is_superuser=False):
-        if not is_superuser:
-            profile_id = await self.get_profile_id(self.get_username())
+        columns, projection, sources = self.compile_projection(self.get_fields())
+        description = []
+        return self.get_readings(columns, description), projection, lambda: columnar.described_types(description, sources)
+
+    # Resolve requested fields once: returns the columns to select, a function building a whole output row
+    # from one selected row, and the selected column each field is copied from (None for computed ones)
+    def compile_projection(self, fields):
+        sources = self.field_sources()
+        columns = []
+
+        def column_index(column):
+            if column not in columns:
+                columns.append(column)
+            return columns.index(column)
+
+        getters = []
+        field_columns = []
+        for field_name in fields:
+            source = sources[field_name]
+            if isinstance(source, str):
+                getters.append(operator.itemgetter(column_index(source)))
+                field_columns.append(column_index(source))
+            else:
+                function, *arguments = source
+                getters.append(derived_getter(function, [column_index(column) for column in arguments]))
+                field_columns.append(None)
+
+        def projection(row):
+            return [getter(row) for getter in getters]
+
+        return columns, projection, field_columns
+
+    async def filter_parameters(self):
+        is_superuser = self.get_username() == "_SUPERUSER"
+        slugs = self.get_slugs()
+
+        if is_superuser:
+            meter_ids = []
         else:
-            profile_id = 0
-        meter_type = self.meter_type()
-        return self.get_meters_list(profile_id, meter_type=meter_type, is_superuser=is_superuser)
+            access = await meter_access.get(self.get_app(), self.get_username())
+            meter_ids = access.meter_ids(slugs, self.meter_type())
 
-    async def get_meters_list(self, profile_id, meter_type, is_superuser=False):
-        slugs = self.get_slugs()
+        return {
+            'meter_ids': meter_ids,
+            'all_users': is_superuser,
+            'empty_slugs': not slugs,
+            'slugs': tuple(slugs) if slugs else ('',),
+            'type': self.meter_type(),
+            'date_from': self.get_date_from(),
+            'date_to': self.get_date_to(),
+        }
 
-        field_names = self.meter_fields().values()
-
-        query = """SELECT /*<select_names>*/*/*</select_names>*/ FROM meters_meter as meter
-         INNER JOIN users_profile_meters as profile_meters 
-         ON meter.id = profile_meters.meter_id
-         WHERE (%(empty_slugs)s OR meter.name IN (%(slugs)s)) 
-         AND %(all_users)s OR (profile_id = %(profile_id)s)
-         AND (meter.type = %(type)s);""".replace('/*<select_names>*/*/*</select_names>*/', ','.join(field_names))
-
-        async with database.openmetrics(self.request.app) as connection:
-            async with connection.cursor() as cursor:
-                await cursor.execute(query, {
-                    'profile_id': profile_id,
-                    'all_users': is_superuser,
-                    'empty_slugs': not slugs,
-                    'slugs': ",".join(slugs) if slugs else ('',),
-                    'type': meter_type
-                })
-                async for row in cursor:
-                    response_item = dict(zip(self.meter_fields(), row))
-                    yield response_item
+    # Statement selecting columns of the readings of the requested meters (see filter_parameters)
+    def select_query(self, columns):
+        select_names = {**self.meter_fields(), **self.reading_fields()}
+        return readings_query.replace(
+            '/*<select_names>*/*/*</select_names>*/', ','.join(select_names[column] for column in columns)
+        ).replace('/*<readings_join>*/', self.readings_join())
+
+    # Selected columns of all readings of all requested meters, ordered by meter and date,
+    # read as one stream over one connection
+    async def get_readings(self, columns, description=None):
+        query = self.select_query(columns)
+
+        parameters = await self.filter_parameters()
+        async with database.openmetrics(self.get_app()) as connection:
+            cursor_rows = database.server_cursor(
+                connection, query, parameters, database.itersize(self.get_app()), description=description
+            )
+            try:
+                async for row in cursor_rows:
+                    yield row
+            finally:
+                await cursor_rows.aclose()
+
+    # ids of the requested meters, those of every user included for the superuser
+    async def meter_ids(self):
+        parameters = await self.filter_parameters()
+        if not parameters['all_users']:
+            return parameters['meter_ids']
+        return await meter_access.all_meter_ids(self.get_app(), self.get_slugs(), self.meter_type())
+
+    async def count_meters(self):
+        return len(await self.meter_ids())
+
+    # File contents of an asynchronous export, progress is counted on the job
+    async def job_chunks(self, job):
+        columns, projection, sources = self.compile_projection(self.get_fields())
+        if 'id' not in columns:
+            columns.append('id')  # not projected, only counted
+        job.meters_total = await self.count_meters()
+
+        description = []
+        rows = job.counted(self.get_readings(columns, description), meter_index=columns.index('id'))
+        chunks = streaming.encode(
+            self.get_app(), self.get_format(), self.get_fields(), rows, projection, self.get_unpivot(),
+            lambda: columnar.described_types(description, sources)
+        )
+        try:
+            async for chunk in chunks:
+                yield chunk
+        finally:
+            await chunks.aclose()
+
+    async def submit_job(self, request, request_function, request_args):
+        if not jobs.enabled(request.app):
+            return web.json_response({'error': "asynchronous exports are not enabled on this server"})
+
+        self.request = request
+        self.request_args = request_args
+        export_format = self.get_format()
+        job = jobs.Job(
+            tokens.handler_name(request_function),
+            streaming.export_filename(f"{self.get_username()}_{self.current_time}", export_format),
+            streaming.FORMATS[export_format][1]
+        )
+        try:
+            jobs.job_queue(request.app).submit(job, self.job_chunks)
+        except asyncio.QueueFull:
+            return web.json_response({'error': "too many export jobs are queued, try again later"})
+
+        return web.json_response({'job': job.id, 'status': f'/jobs/{job.id}'})
 
     def meter_fields(self):
         return {
@@ -124,17 +225,6 @@ class DefaultExporter:
             'paid_until': 'meter.paid_until'
         }
 
-    async def get_profile_id(self, username):
-        query = """SELECT auth_user.id FROM auth_user WHERE auth_user.username = %(username)s;"""
-
-        async with database.openmetrics(self.request.app) as connection:
-            async with connection.cursor() as cursor:
-                await cursor.execute(query, {
-                    'username': username,
-                })
-                profile_id = await cursor.fetchone()
-                return profile_id[0]
-
     # get token
     async def token(self, request, request_function):
         request_data = await request.post()
@@ -153,6 +243,14 @@ class DefaultExporter:
         for field in request_data.getall('fields'):
             if field not in valid_fields:
                 return web.json_response({'error': f"invalid name '{field}' in 'fields'"})
+        export_format = request_data.get('format', 'csv')
+        format_error = streaming.format_error(export_format)
+        if format_error is not None:
+            return web.json_response({'error': format_error})
+        layout = request_data.get('layout', 'wide')
+        layout_error = unpivot.layout_error(layout, request_data.getall('fields'))
+        if layout_error is not None:
+            return web.json_response({'error': layout_error})
 
         token_data = {
             'date_from': request_data['date_from'],
@@ -164,12 +262,28 @@ class DefaultExporter:
             token_data['username'] = request_data['username']
         if 'slugs' in request_data:
             token_data['slugs'] = request_data.getall('slugs')
+        if export_format != 'csv':
+            token_data['format'] = export_format
+        if layout != 'wide':
+            token_data['layout'] = layout
+
+        if request_data.get('async', '0') in ('true', '1'):
+            return await self.submit_job(request, request_function, token_data)
 
         return web.json_response({
             'token': tokens.create_request_token(config(request.app, 'SECRET_KEY'), request_function, **token_data)
         })
 
 
-class Meter:
-    def __init__(self, meter):
-        self.meter = meter
\ No newline at end of file
+def derived_getter(function, indexes):
+    if len(indexes) == 1:
+        index, = indexes
+        return lambda row: function(row[index])
+    if len(indexes) == 2:
+        first, second = indexes
+        return lambda row: function(row[first], row[second])
+    return lambda row: function(*[row[index] for index in indexes])
+
+
+def wh_to_kwh(value):
+    return (value or 0) * 0.001
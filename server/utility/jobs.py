@@ -0,0 +1,172 @@
+import asyncio
+import logging
+import os
+import re
+import secrets
+import time
+
+from aiohttp import web
+
+from server.utility import config
+
+logger = logging.getLogger(__name__)
+
+# Asynchronous exports are written to JOBS_DIR, they are disabled when it is not configured
+JOB_WORKERS = 2
+# Jobs waiting for a worker, further submissions are refused
+JOB_QUEUE_SIZE = 100
+# Seconds a finished (or failed) job and its file are kept
+JOB_TTL = 24 * 60 * 60
+
+__JOB_QUEUE = 'JOB_QUEUE'
+__EXPIRE_INTERVAL = 60
+
+# <job id>.<extension>, with ".part" while it is written
+JOB_FILE = re.compile(r'[0-9a-f]{32}\.[0-9a-z]+(\.part)?')
+
+
+class Job:
+    def __init__(self, handler_name, filename, content_type):
+        self.id = secrets.token_hex(16)
+        self.handler_name = handler_name
+        self.filename = filename
+        self.content_type = content_type
+        self.state = 'queued'  # -> running -> done | failed
+        self.meters_total = None
+        self.meters_done = 0
+        self.rows = 0
+        self.bytes = 0
+        self.created = time.time()
+        self.finished = None
+        self.path = None
+
+    async def counted(self, rows, meter_index=None):
+        # Pass rows through, counting them and (rows being ordered by meter) the meters finished
+        meter_id = None
+        try:
+            async for row in rows:
+                if meter_index is not None and row[meter_index] != meter_id:
+                    if meter_id is not None:
+                        self.meters_done += 1
+                    meter_id = row[meter_index]
+                self.rows += 1
+                yield row
+            if meter_id is not None:
+                self.meters_done += 1
+        finally:
+            await rows.aclose()
+
+    def status(self):
+        status = {
+            'job': self.id,
+            'handler': self.handler_name,
+            'state': self.state,
+            'meters_total': self.meters_total,
+            'meters_done': self.meters_done,
+            'rows': self.rows,
+            'bytes': self.bytes,
+            'created': self.created,
+            'finished': self.finished,
+        }
+        if self.state == 'done':
+            status['download'] = f'/jobs/{self.id}/download'
+        return status
+
+
+class JobQueue:
+    # Jobs live in memory only: job files left by a previous run are removed at startup
+    def __init__(self, directory, workers, queue_size, ttl):
+        self.directory = directory
+        self.workers = workers
+        self.ttl = ttl
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.jobs = {}
+
+        os.makedirs(directory, exist_ok=True)
+        for entry in os.scandir(directory):
+            if entry.is_file(follow_symlinks=False) and JOB_FILE.fullmatch(entry.name):
+                os.remove(entry.path)
+
+    def submit(self, job: Job, chunks_function):
+        # chunks_function(job): async iterable of the file contents, raises asyncio.QueueFull when the queue is full
+        self.expire()
+        self.queue.put_nowait((job, chunks_function))
+        self.jobs[job.id] = job
+
+    def get(self, job_id):
+        self.expire()
+        return self.jobs.get(job_id)
+
+    async def run(self):
+        while True:
+            job, chunks_function = await self.queue.get()
+            await self.execute(job, chunks_function)
+
+    async def expire_periodically(self, interval):
+        # Files of jobs nobody asks about any more are removed too
+        while True:
+            await asyncio.sleep(interval)
+            self.expire()
+
+    async def execute(self, job: Job, chunks_function):
+        job.state = 'running'
+        path = os.path.join(self.directory, job.id + os.path.splitext(job.filename)[1])
+        temporary_path = path + '.part'
+        chunks = chunks_function(job)
+        try:
+            with open(temporary_path, 'wb') as job_file:
+                async for chunk in chunks:
+                    job_file.write(chunk)
+                    job.bytes += len(chunk)
+            os.replace(temporary_path, path)
+        except Exception:
+            logger.exception(f'Export job {job.id} ({job.handler_name}) failed')
+            job.state = 'failed'
+        else:
+            job.path = path
+            job.state = 'done'
+        finally:
+            await chunks.aclose()
+            job.finished = time.time()
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+
+    def expire(self):
+        expired_before = time.time() - self.ttl
+        for job in list(self.jobs.values()):
+            if job.finished is not None and job.finished < expired_before:
+                del self.jobs[job.id]
+                if job.path is not None and os.path.exists(job.path):
+                    os.remove(job.path)
+
+
+async def jobs_ctx(app: web.Application):
+    directory = config(app, 'JOBS_DIR', None)
+    if not directory:
+        yield  # <!> Do not remove this yield
+        return
+
+    job_queue = JobQueue(
+        directory,
+        workers=int(config(app, 'JOB_WORKERS', JOB_WORKERS)),
+        queue_size=int(config(app, 'JOB_QUEUE_SIZE', JOB_QUEUE_SIZE)),
+        ttl=int(config(app, 'JOB_TTL', JOB_TTL)),
+    )
+    app[__JOB_QUEUE] = job_queue
+    workers = [asyncio.ensure_future(job_queue.run()) for _ in range(job_queue.workers)]
+    expire_interval = max(1, min(__EXPIRE_INTERVAL, job_queue.ttl))
+    workers.append(asyncio.ensure_future(job_queue.expire_periodically(expire_interval)))
+    yield  # <!> Do not remove this yield
+    # Running jobs are abandoned, their partial files removed
+    for worker in workers:
+        worker.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+
+
+def enabled(app: web.Application):
+    return __JOB_QUEUE in app
+
+
+def job_queue(app: web.Application) -> JobQueue:
+    assert __JOB_QUEUE in app
+    return app[__JOB_QUEUE]
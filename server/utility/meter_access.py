@@ -0,0 +1,107 @@
+import asyncio
+import collections
+
+from aiohttp import web
+
+from server.utility import cache, config, database
+
+# username -> profile id and meters, for the openmetrics users (remote names)
+METER_ACCESS_CACHE_SIZE = 4096
+METER_ACCESS_CACHE_TTL = 300
+# NOTIFY channel of the openmetrics triggers, payload is the username whose meters changed ('' for everyone)
+METER_ACCESS_CHANNEL = 'meter_access_changed'
+
+__METER_ACCESS_CACHE = 'METER_ACCESS_CACHE'
+
+Meter = collections.namedtuple('Meter', ('id', 'name', 'mpan', 'location', 'type'))
+
+
+class MeterAccess:
+    # What one openmetrics user can read: profile_id is None for unknown usernames
+    def __init__(self, profile_id, meters):
+        self.profile_id = profile_id
+        self.meters = collections.OrderedDict((meter.id, meter) for meter in meters)
+
+    def meter_ids(self, names=None, meter_type=None):
+        # ids of the user's meters, narrowed by names (slugs) and type, in id order
+        return [
+            meter.id for meter in self.meters.values()
+            if (not names or meter.name in names) and (meter_type is None or meter.type == meter_type)
+        ]
+
+
+async def meter_access_ctx(app: web.Application):
+    app[__METER_ACCESS_CACHE] = cache.TTLCache(
+        maxsize=int(config(app, 'METER_ACCESS_CACHE_SIZE', METER_ACCESS_CACHE_SIZE)),
+        ttl=float(config(app, 'METER_ACCESS_CACHE_TTL', METER_ACCESS_CACHE_TTL)),
+    )
+    listener = asyncio.ensure_future(
+        database.listen(config(app, 'OPENMETRICS_DSN'), METER_ACCESS_CHANNEL, lambda username: invalidate(app, username))
+    )
+    yield  # <!> Do not remove this yield
+    listener.cancel()
+    try:
+        await listener
+    except asyncio.CancelledError:
+        pass
+
+
+def invalidate(app: web.Application, username=None):
+    meter_access_cache = app[__METER_ACCESS_CACHE]
+    meter_access_cache.invalidate()
+    if not username:
+        meter_access_cache.clear()
+        return
+    meter_access_cache.pop(username)
+
+
+meter_access_query = """
+        SELECT auth_user.id, meter.id, meter.name, meter.mpan, meter.location, meter.type
+        FROM auth_user
+        LEFT JOIN users_profile_meters AS profile_meters ON profile_meters.profile_id = auth_user.id
+        LEFT JOIN meters_meter AS meter ON meter.id = profile_meters.meter_id
+        WHERE auth_user.username = %(username)s
+        ORDER BY meter.id;
+    """
+
+
+async def all_meter_ids(app: web.Application, names=None, meter_type=None):
+    # ids of every meter (superuser exports), narrowed like MeterAccess.meter_ids()
+    query = """
+        SELECT meter.id FROM meters_meter AS meter
+        WHERE (%(all_names)s OR meter.name IN %(names)s) AND (%(all_types)s OR meter.type = %(type)s)
+        ORDER BY meter.id;
+    """
+    async with database.openmetrics(app) as connection:
+        async with connection.cursor() as cursor:
+            await database.execute(cursor, query, {
+                'all_names': not names,
+                'names': tuple(names) if names else ('',),
+                'all_types': meter_type is None,
+                'type': meter_type,
+            })
+            return [meter_id for meter_id, in await cursor.fetchall()]
+
+
+async def select_meter_access(app: web.Application, username):
+    profile_id = None
+    meters = []
+    async with database.openmetrics(app) as connection:
+        async with connection.cursor() as cursor:
+            await database.execute(cursor, meter_access_query, {'username': username})
+            async for profile_id, *meter in cursor:
+                if meter[0] is not None:
+                    meters.append(Meter(*meter))
+    return MeterAccess(profile_id, meters)
+
+
+async def get(app: web.Application, username) -> MeterAccess:
+    meter_access_cache = app[__METER_ACCESS_CACHE]
+    access = meter_access_cache.get(username)
+    if access is None:
+        generation = meter_access_cache.generation
+        access = await select_meter_access(app, username)
+        # not cached when meters changed during the query: it may have read them before the change
+        if meter_access_cache.generation == generation:
+            meter_access_cache.set(username, access)
+    return access
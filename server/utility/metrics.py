@@ -0,0 +1,152 @@
+import bisect
+import time
+
+from aiohttp import web
+
+# Process wide metrics in the Prometheus text exposition format (version 0.0.4)
+REGISTRY = []
+
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in labels) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), register=True):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        if register:
+            REGISTRY.append(self)
+
+    def key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def samples(self):
+        for key, value in sorted(self.values.items()):
+            yield self.name, list(zip(self.labelnames, key)), value
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for name, labels, value in self.samples():
+            lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        self.values[self.key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS, register=True):
+        super().__init__(name, documentation, labelnames, register)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        if key not in self.values:
+            self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+        counts, _, _ = state = self.values[key]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(counts):
+            counts[index] += 1
+        state[1] += value
+        state[2] += 1
+
+    def samples(self):
+        for key, (counts, total, count) in sorted(self.values.items()):
+            labels = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield f'{self.name}_bucket', labels + [('le', format_value(float(bound)))], cumulative
+            yield f'{self.name}_bucket', labels + [('le', '+Inf')], count
+            yield f'{self.name}_sum', labels, total
+            yield f'{self.name}_count', labels, count
+
+
+REQUEST_DURATION = Histogram(
+    'api_request_duration_seconds', 'Time to produce the complete response, streamed bodies included.',
+    ('route', 'handler', 'method', 'status'),
+)
+REQUESTS_IN_FLIGHT = Gauge('api_requests_in_flight', 'Requests being processed.', ('route',))
+ROWS_STREAMED = Counter('api_rows_streamed_total', 'Rows encoded into streamed responses.', ('handler',))
+BYTES_WRITTEN = Counter('api_response_bytes_total', 'Bytes written by streamed responses, after compression.', ('handler',))
+DB_QUERY_DURATION = Histogram('api_db_query_duration_seconds', 'Time spent executing database statements.')
+
+
+def exposition(extra_metrics=()):
+    lines = []
+    for metric in [*REGISTRY, *extra_metrics]:
+        lines.extend(metric.expose())
+    return '\n'.join(lines) + '\n'
+
+
+def route_name(request):
+    resource = request.match_info.route.resource
+    if resource is None:
+        return 'unmatched'
+    return getattr(resource, 'canonical', None) or resource.get_info().get('path', 'unknown')
+
+
+def handler_name(request):
+    # token handler for /download, the route otherwise
+    return request.get('token_handler') or route_name(request)
+
+
+@web.middleware
+async def metrics_middleware(request, handler):
+    route = route_name(request)
+    REQUESTS_IN_FLIGHT.inc(route=route)
+    started = time.monotonic()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as exception:
+        status = exception.status
+        raise
+    finally:
+        REQUESTS_IN_FLIGHT.dec(route=route)
+        REQUEST_DURATION.observe(
+            time.monotonic() - started,
+            route=route, handler=request.get('token_handler', ''), method=request.method, status=status
+        )
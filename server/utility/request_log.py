@@ -0,0 +1,99 @@
+import asyncio
+import datetime
+import itertools
+import logging
+
+from aiohttp import web
+
+from server.utility import config, database
+
+logger = logging.getLogger(__name__)
+
+# Entries waiting for a flush, new entries are dropped (and counted) once it is full
+REQUEST_LOG_QUEUE_SIZE = 10000
+# Rows per INSERT, a full batch is flushed immediately
+REQUEST_LOG_BATCH_SIZE = 500
+# Seconds between flushes of a partial batch
+REQUEST_LOG_FLUSH_INTERVAL = 2.0
+
+__REQUEST_LOG_WRITER = 'REQUEST_LOG_WRITER'
+
+
+class RequestLogWriter:
+    def __init__(self, app, queue_size, batch_size, flush_interval):
+        self.app = app
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.written = 0
+        self.dropped = 0
+        self.closing = asyncio.Event()
+        self.__runner = None
+        self.__batch_flush = None
+
+    def log(self, name):
+        try:
+            self.queue.put_nowait((datetime.datetime.now(), name))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return
+        if self.queue.qsize() >= self.batch_size and (self.__batch_flush is None or self.__batch_flush.done()):
+            self.__batch_flush = asyncio.ensure_future(self.flush())
+
+    def start(self):
+        self.__runner = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        while not self.closing.is_set():
+            try:
+                await asyncio.wait_for(self.closing.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    async def close(self):
+        # Let running flushes finish, then write out what is left while the local storage pool is still open
+        self.closing.set()
+        await asyncio.gather(*[task for task in (self.__runner, self.__batch_flush) if task is not None])
+        await self.flush()
+
+    async def flush(self):
+        while not self.queue.empty():
+            batch = [self.queue.get_nowait() for _ in range(min(self.batch_size, self.queue.qsize()))]
+            await self.write(batch)
+
+    async def write(self, batch):
+        request_log = """
+             INSERT INTO request_log (datetime, name) 
+                 VALUES 
+        """ + ','.join(['(%s, %s)'] * len(batch))
+        try:
+            async with database.local_storage(self.app) as conn:
+                async with conn.cursor() as cursor:
+                    await database.execute(cursor, request_log, list(itertools.chain.from_iterable(batch)))
+        except asyncio.CancelledError:
+            self.dropped += len(batch)
+            raise
+        except Exception:
+            logger.exception(f'Failed to write {len(batch)} request_log entries')
+            self.dropped += len(batch)
+        else:
+            self.written += len(batch)
+
+
+async def request_log_ctx(app: web.Application):
+    writer = RequestLogWriter(
+        app,
+        queue_size=int(config(app, 'REQUEST_LOG_QUEUE_SIZE', REQUEST_LOG_QUEUE_SIZE)),
+        batch_size=int(config(app, 'REQUEST_LOG_BATCH_SIZE', REQUEST_LOG_BATCH_SIZE)),
+        flush_interval=float(config(app, 'REQUEST_LOG_FLUSH_INTERVAL', REQUEST_LOG_FLUSH_INTERVAL)),
+    )
+    app[__REQUEST_LOG_WRITER] = writer
+    writer.start()
+    yield  # <!> Do not remove this yield
+    await writer.close()
+
+
+def writer(app: web.Application) -> RequestLogWriter:
+    assert __REQUEST_LOG_WRITER in app
+    return app[__REQUEST_LOG_WRITER]
@@ -0,0 +1,222 @@
+import asyncio
+import datetime
+import logging
+
+from aiohttp import web
+
+from server.utility import config, database
+
+logger = logging.getLogger(__name__)
+
+# Seconds between two runs adding newly completed periods to the rollup tables, 0 = no maintenance
+ROLLUP_INTERVAL = 3600
+# Days after the end of a period before it is stored: readings arriving later are not seen by stored periods
+ROLLUP_SETTLE_DAYS = 7
+# Rows per INSERT into readings_rollup
+ROLLUP_BATCH_SIZE = 1000
+
+PERIODS = ('week', 'month', 'year')
+
+# Totals per meter and period: daily import/export readings and the emc1sp kWh fields.
+# emc1sp fields only count days emc1sp reports (with spc and gas readings).
+TOTAL_FIELDS = (
+    'day_total_wh',
+    'export_day_total_wh',
+    'domestic_load_kwh',
+    'grid_energy_utilised_kwh',
+    'grid_export_kwh',
+    'solar_storage_utilised_kwh',
+    'generation_kwh',
+    'battery_charge_kwh',
+)
+
+aggregate_query = """-- noinspection SqlResolveForFile
+    -- sums are cast: integer columns would be divided as integers, bigint ones summed up as numeric
+    SELECT r.meter_id, date_trunc(%(period)s, r.date)::date AS period_start, count(*) AS days,
+        sum(r.import_total)::double precision, -- day_total_wh
+        sum(r.export_total)::double precision, -- export_day_total_wh
+        sum(r.export_total_wh) FILTER (WHERE emc1sp)::double precision / 1000, -- domestic_load_kwh
+        sum(spc.grid_energy_wh) FILTER (WHERE emc1sp)::double precision / 1000, -- grid_energy_utilised_kwh
+        sum(r.import_total_wh) FILTER (WHERE emc1sp)::double precision / 1000, -- grid_export_kwh
+        sum(r.export_total_wh_b) FILTER (WHERE emc1sp)::double precision / 1000, -- solar_storage_utilised_kwh
+        sum(spc.generation_wh) FILTER (WHERE emc1sp)::double precision / 1000, -- generation_kwh
+        sum(spc.charge_wh) FILTER (WHERE emc1sp)::double precision / 1000 -- battery_charge_kwh
+    FROM readings_reading AS r
+    LEFT JOIN readings_spcreading AS spc ON (r.name=spc.name)
+    LEFT JOIN readings_gasreading AS g ON (r.name=g.name)
+    CROSS JOIN LATERAL (SELECT spc.name IS NOT NULL AND g.name IS NOT NULL AS emc1sp) AS emc1sp_day
+    WHERE /*<meters_filter>*/
+    AND /*<dates_filter>*/
+    GROUP BY r.meter_id, period_start
+    ORDER BY r.meter_id, period_start;
+"""
+
+# periods starting between from_date and to_date, not before since (when given)
+live_query = aggregate_query.replace('/*<meters_filter>*/', 'r.meter_id = ANY(%(meter_ids)s)').replace(
+    '/*<dates_filter>*/', """r.date >= GREATEST(date_trunc(%(period)s, %(from_date)s::date), %(since)s)
+        AND r.date < date_trunc(%(period)s, %(to_date)s::date) + ('1 ' || %(period)s)::interval"""
+)
+
+__ROLLUP_LOCK = 7_403_112  # transaction advisory lock of the local storage, one server process stores a period at a time
+
+
+def period_start(period, date: datetime.date):
+    # same as date_trunc(period, date): weeks start on Monday
+    if period == 'week':
+        return date - datetime.timedelta(days=date.weekday())
+    if period == 'month':
+        return date.replace(day=1)
+    return date.replace(month=1, day=1)
+
+
+def period_end(period, start: datetime.date):
+    # first day of the next period
+    if period == 'week':
+        return start + datetime.timedelta(days=7)
+    if period == 'month':
+        return (start + datetime.timedelta(days=31)).replace(day=1)
+    return start.replace(year=start.year + 1)
+
+
+async def state(cursor, period):
+    # first day not covered by the stored periods, None when nothing is stored yet
+    await database.execute(cursor, """
+        SELECT rolled_up_to FROM readings_rollup_state WHERE period = %(period)s;
+    """, {'period': period})
+    row = await cursor.fetchone()
+    return row[0] if row else None
+
+
+async def rolled_up_to(app: web.Application, period):
+    async with database.local_storage(app) as connection:
+        async with connection.cursor() as cursor:
+            return await state(cursor, period)
+
+
+async def stored_totals(app: web.Application, period, meter_ids, from_date, to_date, until):
+    # rows of the stored periods starting in the range, as aggregate_query returns them
+    async with database.local_storage(app) as connection:
+        async with connection.cursor() as cursor:
+            await database.execute(cursor, f"""
+                SELECT meter_id, period_start, days, {', '.join(TOTAL_FIELDS)} FROM readings_rollup
+                WHERE period = %(period)s AND meter_id = ANY(%(meter_ids)s)
+                AND period_start >= date_trunc(%(period)s, %(from_date)s::date) AND period_start <= %(to_date)s
+                AND period_start < %(until)s
+                ORDER BY meter_id, period_start;
+            """, {
+                'period': period, 'meter_ids': meter_ids, 'from_date': from_date, 'to_date': to_date, 'until': until,
+            })
+            return await cursor.fetchall()
+
+
+def live_totals(app: web.Application, period, meter_ids, from_date, to_date, since):
+    # aggregated from the readings: periods starting in the range, not before since (when given)
+    return database.openmetrics_rows(app, live_query, {
+        'period': period, 'meter_ids': meter_ids, 'from_date': from_date, 'to_date': to_date, 'since': since,
+    })
+
+
+async def first_period(app: web.Application, period, end):
+    # start of the period of the oldest reading, end when there is none before it
+    async with database.openmetrics(app) as connection:
+        async with connection.cursor() as cursor:
+            await database.execute(cursor, """
+                SELECT min(date) FROM readings_reading WHERE date < %(end)s;
+            """, {'end': end})
+            first_date, = await cursor.fetchone()
+    return end if first_date is None else period_start(period, first_date)
+
+
+async def roll_up_period(app: web.Application, cursor, period, end):
+    # Store the next completed period in a transaction of its own, None when there is none
+    # or another server process holds the lock
+    insert_query = f"""
+        INSERT INTO readings_rollup (period, meter_id, period_start, days, {', '.join(TOTAL_FIELDS)}) VALUES /*<values>*/
+        ON CONFLICT (period, meter_id, period_start) DO UPDATE SET
+        days = excluded.days, {', '.join(f'{field} = excluded.{field}' for field in TOTAL_FIELDS)};
+    """
+    row_values = '(' + ', '.join(['%s'] * (3 + len(TOTAL_FIELDS) + 1)) + ')'
+    batch_size = int(config(app, 'ROLLUP_BATCH_SIZE', ROLLUP_BATCH_SIZE))
+
+    async def insert(batch):
+        await database.execute(
+            cursor, insert_query.replace('/*<values>*/', ','.join([row_values] * len(batch))),
+            [value for row in batch for value in (period, *row)]
+        )
+
+    query = aggregate_query.replace('/*<meters_filter>*/', 'TRUE').replace(
+        '/*<dates_filter>*/', 'r.date >= %(start)s AND r.date < %(end)s'
+    )
+
+    stored = None
+    await database.execute(cursor, 'BEGIN;')
+    try:
+        # released by COMMIT / ROLLBACK
+        await database.execute(cursor, 'SELECT pg_try_advisory_xact_lock(%s);', (__ROLLUP_LOCK,))
+        locked, = await cursor.fetchone()
+        rolled_up_to = await state(cursor, period) if locked else None
+        if locked and (rolled_up_to is None or rolled_up_to < end):
+            start = rolled_up_to if rolled_up_to is not None else await first_period(app, period, end)
+            period_stop = min(period_end(period, start), end)
+            stored = 0
+            batch = []
+            async for row in database.openmetrics_rows(app, query, {'period': period, 'start': start, 'end': period_stop}):
+                batch.append(row)
+                if len(batch) >= batch_size:
+                    await insert(batch)
+                    stored += len(batch)
+                    batch = []
+            if batch:
+                await insert(batch)
+                stored += len(batch)
+            await database.execute(cursor, """
+                INSERT INTO readings_rollup_state (period, rolled_up_to) VALUES (%(period)s, %(end)s)
+                ON CONFLICT (period) DO UPDATE SET rolled_up_to = excluded.rolled_up_to;
+            """, {'period': period, 'end': period_stop})
+    except BaseException:
+        await database.execute(cursor, 'ROLLBACK;')
+        raise
+    await database.execute(cursor, 'COMMIT;' if stored is not None else 'ROLLBACK;')
+    return stored
+
+
+async def roll_up(app: web.Application, cursor, period, settled_date):
+    # Store the periods completed since the last run one after the other, only the readings of those periods are read
+    end = period_start(period, settled_date)
+    stored = 0
+    while True:
+        period_stored = await roll_up_period(app, cursor, period, end)
+        if period_stored is None:
+            return stored
+        stored += period_stored
+
+
+async def maintain(app: web.Application):
+    settled_date = datetime.date.today() - datetime.timedelta(days=int(config(app, 'ROLLUP_SETTLE_DAYS', ROLLUP_SETTLE_DAYS)))
+    async with database.local_storage(app) as connection:
+        async with connection.cursor() as cursor:
+            for period in PERIODS:
+                stored = await roll_up(app, cursor, period, settled_date)
+                if stored:
+                    logger.info(f'Stored {stored} {period} rollups')
+
+
+async def run(app: web.Application, interval):
+    while True:
+        try:
+            await maintain(app)
+        except Exception:
+            logger.exception('Failed to update the rollup tables')
+        await asyncio.sleep(interval)
+
+
+async def rollup_ctx(app: web.Application):
+    interval = float(config(app, 'ROLLUP_INTERVAL', ROLLUP_INTERVAL))
+    task = asyncio.ensure_future(run(app, interval)) if interval > 0 else None
+    yield  # <!> Do not remove this yield
+    if task is not None:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
@@ -0,0 +1,102 @@
+import asyncio
+import datetime
+import math
+
+from aiohttp import web
+
+from server.utility import config
+
+# Batches a running shard reads ahead of the one being sent
+SHARD_PREFETCH = 4
+# Shards per degree of parallelism: smaller shards keep the connections busy when their sizes differ
+SHARDS_PER_WORKER = 4
+
+__DONE = object()
+
+
+def parallelism(app: web.Application, name, default=1):
+    return max(1, int(config(app, name, default)))
+
+
+def shard_count(app: web.Application, workers):
+    return workers * int(config(app, 'SHARDS_PER_WORKER', SHARDS_PER_WORKER))
+
+
+def prefetch_size(app: web.Application):
+    return max(1, int(config(app, 'SHARD_PREFETCH', SHARD_PREFETCH)))
+
+
+def split(items, count):
+    # items in at most count consecutive, non empty groups of about the same size
+    size = max(1, math.ceil(len(items) / count))
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
+
+def date_ranges(date_from, date_to, count):
+    # [start, end) datetime ranges covering date_from .. date_to (ISO strings) in whole days, None when unparsable
+    try:
+        start = datetime.datetime.fromisoformat(str(date_from))
+        end = datetime.datetime.fromisoformat(str(date_to))
+        days = max(1, math.ceil((end - start) / datetime.timedelta(days=1)))
+    except (ValueError, TypeError):
+        return None
+    step = datetime.timedelta(days=max(1, math.ceil(days / count)))
+    ranges = []
+    while start <= end:
+        ranges.append((start, start + step))
+        start += step
+    return ranges
+
+
+async def __pump(source, batch_size, queue: asyncio.Queue):
+    try:
+        batch = []
+        async for item in source:
+            batch.append(item)
+            if len(batch) >= batch_size:
+                await queue.put(batch)
+                batch = []
+        if batch:
+            await queue.put(batch)
+        await queue.put(__DONE)
+    except asyncio.CancelledError:
+        raise
+    except Exception as exception:
+        await queue.put(exception)
+    finally:
+        await source.aclose()
+
+
+async def concatenated(shards, workers, batch_size=1, prefetch=SHARD_PREFETCH):
+    # Items of shards (functions returning async generators, in output order) one shard after the other,
+    # while up to workers shards run at once, each reading up to prefetch batches of batch_size items ahead
+    shards = list(shards)
+    running = []  # (task, queue) of the next shards, in order
+
+    def start_next():
+        started = len(running) + consumed
+        if started < len(shards):
+            queue = asyncio.Queue(maxsize=prefetch)
+            running.append((asyncio.ensure_future(__pump(shards[started](), batch_size, queue)), queue))
+
+    consumed = 0
+    try:
+        for _ in range(workers):
+            start_next()
+        while running:
+            task, queue = running[0]
+            while True:
+                batch = await queue.get()
+                if batch is __DONE:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                for item in batch:
+                    yield item
+            running.pop(0)
+            consumed += 1
+            start_next()
+    finally:
+        for task, _ in running:
+            task.cancel()
+        await asyncio.gather(*[task for task, _ in running], return_exceptions=True)
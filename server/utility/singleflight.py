@@ -0,0 +1,160 @@
+import asyncio
+
+from aiohttp import web
+
+from server.utility import config
+
+# Bytes of an export kept for requests joining it late: the whole output while it is smaller, joining is closed
+# past it. Also the most a flight holds for its slowest subscriber before it waits. 0 disables coalescing.
+SINGLEFLIGHT_BUFFER_SIZE = 8 * 1024 * 1024
+
+__FLIGHTS = 'SINGLEFLIGHT_FLIGHTS'
+
+
+class Flight:
+    # One export produced once, its chunks handed to every subscriber
+    def __init__(self, flights, key, chunks, buffer_size):
+        self.flights = flights
+        self.key = key
+        self.source = chunks
+        self.buffer_size = buffer_size
+        self.chunks = []  # retained chunks, chunks[0] is chunk number self.first
+        self.first = 0
+        self.retained = 0
+        self.joinable = True  # the whole output is still retained
+        self.finished = False
+        self.error = None
+        self.positions = {}  # subscriber -> number of the next chunk it reads
+        self.changed = asyncio.Condition()
+        self.task = None
+
+    async def produce(self):
+        try:
+            async for chunk in self.source:
+                async with self.changed:
+                    self.chunks.append(chunk)
+                    self.retained += len(chunk)
+                    if self.retained > self.buffer_size:
+                        self.close()
+                    self.changed.notify_all()
+                    # hold back for the slowest subscriber rather than buffering without bound
+                    while self.positions and not self.joinable and self.trim() > self.buffer_size:
+                        await self.changed.wait()
+        except asyncio.CancelledError:
+            raise
+        except Exception as exception:
+            self.error = exception
+        finally:
+            await self.source.aclose()
+            self.close()
+            async with self.changed:
+                self.finished = True
+                self.changed.notify_all()
+
+    def close(self):
+        # identical requests start their own export from now on, they could not replay the beginning
+        self.joinable = False
+        if self.flights.get(self.key) is self:
+            del self.flights[self.key]
+
+    def trim(self):
+        # drop the chunks read by every subscriber, returns the bytes still retained
+        read = min(self.positions.values()) - self.first
+        if read > 0:
+            self.retained -= sum(len(chunk) for chunk in self.chunks[:read])
+            del self.chunks[:read]
+            self.first += read
+        return self.retained
+
+    def subscribe(self):
+        return Subscription(self)
+
+    def unsubscribe(self, subscription):
+        del self.positions[subscription]
+        if not self.positions and not self.finished:
+            # the last client went away: stop the export like a single client would
+            self.close()
+            self.task.cancel()
+
+
+class Subscription:
+    # Async iterator over the chunks of a flight, counted as reading from its creation until aclose()
+    def __init__(self, flight: Flight):
+        self.flight = flight
+        self.position = flight.first
+        self.closed = False
+        flight.positions[self] = self.position
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        flight = self.flight
+        if self.closed:
+            raise StopAsyncIteration
+        async with flight.changed:
+            while self.position >= flight.first + len(flight.chunks) and not flight.finished:
+                await flight.changed.wait()
+            if self.position >= flight.first + len(flight.chunks):
+                if flight.error is not None:
+                    raise flight.error
+                raise StopAsyncIteration
+            chunk = flight.chunks[self.position - flight.first]
+            self.position += 1
+            flight.positions[self] = self.position
+            flight.changed.notify_all()
+        return chunk
+
+    async def aclose(self):
+        if not self.closed:
+            self.closed = True
+            async with self.flight.changed:
+                self.flight.unsubscribe(self)
+                # the producer may be waiting for this subscriber
+                self.flight.changed.notify_all()
+
+
+class Flights(dict):
+    def __init__(self, buffer_size):
+        super().__init__()
+        self.buffer_size = buffer_size
+        self.started = 0
+        self.joined = 0
+
+
+async def singleflight_ctx(app: web.Application):
+    buffer_size = int(config(app, 'SINGLEFLIGHT_BUFFER_SIZE', SINGLEFLIGHT_BUFFER_SIZE))
+    if buffer_size > 0:
+        app[__FLIGHTS] = Flights(buffer_size)
+    yield  # <!> Do not remove this yield
+    if buffer_size > 0:
+        tasks = [flight.task for flight in app[__FLIGHTS].values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def get(app: web.Application):
+    # None when coalescing is disabled
+    return app.get(__FLIGHTS)
+
+
+async def shared_chunks(app: web.Application, key, chunks):
+    # Chunks of the export identified by key: those of a running identical export when it can still be joined
+    # (chunks are then closed unused), otherwise chunks, shared with the identical requests coming while it runs
+    flights = get(app)
+    if flights is None or key is None:
+        return chunks
+
+    flight = flights.get(key)
+    if flight is not None and flight.joinable:
+        await chunks.aclose()
+        flights.joined += 1
+        return flight.subscribe()
+
+    flight = Flight(flights, key, chunks, flights.buffer_size)
+    flights[key] = flight
+    flights.started += 1
+    subscription = flight.subscribe()
+    flight.task = asyncio.ensure_future(flight.produce())
+    return subscription
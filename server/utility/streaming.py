@@ -0,0 +1,210 @@
+import csv
+import datetime
+import io
+import json
+import os
+
+from aiohttp import web
+
+from server.utility import config, columnar, compression, encoding, metrics, singleflight
+
+# NDJSON (and cached files) are flushed to the client as soon as the buffer reaches this size
+CSV_CHUNK_SIZE = 64 * 1024
+
+# export format -> (file suffix, content type)
+FORMATS = {
+    'csv': ('.csv', 'text/csv'),
+    'parquet': ('.parquet', 'application/vnd.apache.parquet'),
+    'arrow': ('.arrow', 'application/vnd.apache.arrow.stream'),
+}
+
+
+def chunk_size(app):
+    return int(config(app, 'CSV_CHUNK_SIZE', CSV_CHUNK_SIZE))
+
+
+def csv_value(value):
+    if isinstance(value, datetime.datetime):
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    if isinstance(value, datetime.date):
+        return value.strftime("%Y-%m-%d")
+    return value
+
+
+def format_error(export_format):
+    if export_format not in FORMATS:
+        return f"invalid 'format', expected one of: {', '.join(FORMATS)}"
+    if export_format != 'csv' and not columnar.available():
+        return f"'{export_format}' format is not available on this server"
+    return None
+
+
+def export_filename(prefix, export_format):
+    if export_format == 'csv':
+        return f'{prefix}_csvexport.csv'
+    return f'{prefix}_export{FORMATS[export_format][0]}'
+
+
+def encode(app, export_format, header, rows, projection=None, unpivot=None, types=None):
+    # projection builds the output row from a raw row, it runs in the encoder threads
+    # as does unpivot, turning the projected rows into "long" layout rows.
+    # types gives the column types of "parquet" and "arrow" exports, see columnar.described_types()
+    if export_format == 'csv':
+        size = encoding.batch_size(app)
+        encoder = CsvEncoder(header, projection, unpivot)
+    else:
+        size = int(config(app, 'ARROW_BATCH_SIZE', columnar.ARROW_BATCH_SIZE))
+        encoder = columnar.ColumnarEncoder(export_format, header, projection, unpivot, types)
+    if unpivot is not None:
+        # batch sizes count output rows, every wide row gives one per half hour
+        size = max(1, size // max(1, unpivot.slots))
+    return encoding.encoded_chunks(app, encoder, rows, size=size)
+
+
+async def counted_rows(request, rows):
+    handler = metrics.handler_name(request)
+    try:
+        async for row in rows:
+            metrics.ROWS_STREAMED.inc(handler=handler)
+            yield row
+    finally:
+        await rows.aclose()
+
+
+async def send_export(request, filename_prefix, export_format, header, rows, cache=None, projection=None, unpivot=None,
+                      types=None):
+    suffix, content_type = FORMATS[export_format]
+    return await send_attachment(
+        request, export_filename(filename_prefix, export_format),
+        encode(request.app, export_format, header, counted_rows(request, rows), projection, unpivot, types),
+        content_type=content_type, cache=cache
+    )
+
+
+class CsvEncoder:
+    # Batches are independent of each other, several of them can be encoded at once
+    stateful = False
+
+    def __init__(self, header, projection=None, unpivot=None):
+        self.header = header if unpivot is None else unpivot.header
+        self.projection = projection
+        self.unpivot = unpivot
+
+    def start(self):
+        csv_buffer = io.StringIO()
+        csv.writer(csv_buffer).writerow(self.header)
+        return csv_buffer.getvalue().encode()
+
+    def encode(self, batch):
+        # batch: raw rows, sequences ordered like header once projected
+        if self.projection is not None:
+            batch = map(self.projection, batch)
+        if self.unpivot is not None:
+            batch = self.unpivot(batch)
+        csv_buffer = io.StringIO()
+        writer = csv.writer(csv_buffer)
+        for row in batch:
+            writer.writerow([csv_value(value) for value in row])
+        return csv_buffer.getvalue().encode()
+
+    def finish(self):
+        return b''
+
+
+async def file_chunks(path, chunk_size=CSV_CHUNK_SIZE):
+    with open(path, 'rb') as file:
+        while True:
+            chunk = file.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+async def send_attachment(request, filename, chunks, content_type='text/csv', cache=None):
+    encoding = compression.negotiate(request)
+
+    cached_path = None if cache is None else cache.lookup()
+    if cached_path is not None:
+        await chunks.aclose()
+        if encoding is None:
+            return web.FileResponse(cached_path, headers={
+                'CONTENT-DISPOSITION': f'attachment; filename="{filename}"'
+            })
+        chunks = file_chunks(cached_path, chunk_size(request.app))
+    else:
+        if cache is not None:
+            chunks = cache.store(os.path.splitext(filename)[1], chunks)
+        # identical downloads coming meanwhile get these chunks instead of running their own export
+        chunks = await singleflight.shared_chunks(request.app, request.get('export_key'), chunks)
+
+    response = web.StreamResponse()
+    response.content_type = content_type
+    response.headers['CONTENT-DISPOSITION'] = f'attachment; filename="{filename}"'
+    return await send_chunks(request, response, chunks)
+
+
+async def send_chunks(request, response, chunks):
+    # Headers go out before the first chunk is produced, so the query runs while the client is already connected
+    encoding = compression.negotiate(request)
+    response.headers['VARY'] = 'Accept-Encoding'
+    if encoding is not None:
+        response.headers['CONTENT-ENCODING'] = encoding
+        chunks = compression.compress_chunks(request.app, encoding, chunks)
+
+    handler = metrics.handler_name(request)
+    await response.prepare(request)
+    try:
+        async for chunk in chunks:
+            await response.write(chunk)
+            metrics.BYTES_WRITTEN.inc(len(chunk), handler=handler)
+    except BaseException:
+        # a failed export must not end like a complete one: drop the connection instead of terminating the body
+        if request.transport is not None:
+            request.transport.close()
+        raise
+    finally:
+        # release the query (and discard a partial cache file) right away when the client goes away
+        await chunks.aclose()
+    await response.write_eof()
+    return response
+
+
+async def json_response(request, data):
+    body = json.dumps(data).encode()
+    headers = {'VARY': 'Accept-Encoding'}
+
+    encoding = compression.negotiate(request)
+    if encoding is not None and len(body) >= int(config(request.app, 'COMPRESSION_MIN_SIZE', compression.COMPRESSION_MIN_SIZE)):
+        body = await compression.compress_body(request.app, encoding, body)
+        headers['CONTENT-ENCODING'] = encoding
+
+    return web.Response(body=body, content_type='application/json', headers=headers)
+
+
+def wants_ndjson(request, body):
+    return (
+        'application/x-ndjson' in request.headers.get('Accept', '') or
+        body.get('stream', '0') in ('true', '1')
+    )
+
+
+async def ndjson_chunks(items, chunk_size=CSV_CHUNK_SIZE):
+    # items: async iterable of JSON serializable objects, one per line
+    lines = []
+    size = 0
+    async for item in items:
+        line = json.dumps(item).encode() + b'\n'
+        lines.append(line)
+        size += len(line)
+        if size >= chunk_size:
+            yield b''.join(lines)
+            lines = []
+            size = 0
+    if lines:
+        yield b''.join(lines)
+
+
+async def ndjson_response(request, items):
+    response = web.StreamResponse()
+    response.content_type = 'application/x-ndjson'
+    return await send_chunks(request, response, ndjson_chunks(counted_rows(request, items), chunk_size(request.app)))
@@ -1,5 +1,6 @@
 import base64
 import hashlib
+import hmac
 import json
 import urllib.parse
 import pyaes
@@ -33,6 +34,10 @@ def register_token_handler(func_name):
     return decorator
 
 
+def handler_name(request_function):
+    return __REQUEST_TO_STRING[request_function]
+
+
 def create_request_token(secret_key: str, request_function,  **request_args):
     return __encode_token(secret_key, tr=__REQUEST_TO_STRING[request_function], ra=request_args, v=2)
 
@@ -50,3 +55,21 @@ def parse_request_token(secret_key: str, token):
 
     else:  # Legacy version only for "requests/get" endpoint
         return __STRING_TO_REQUEST['readings/get'], token_data
+
+
+def __sign(secret_key: str, data):
+    return hmac.new(secret_key.encode(), json.dumps(data, sort_keys=True).encode(), hashlib.sha256).hexdigest()
+
+
+def create_cursor(secret_key: str, **position):
+    # Opaque continuation cursor of a paginated response, encoded like the request tokens and signed
+    return __encode_token(secret_key, c=position, s=__sign(secret_key, position))
+
+
+def parse_cursor(secret_key: str, cursor):
+    cursor_data = __decode_token(secret_key, cursor)
+    if not isinstance(cursor_data, dict) or not isinstance(cursor_data.get('c'), dict):
+        raise ValueError("Invalid cursor")
+    if not hmac.compare_digest(str(cursor_data.get('s')), __sign(secret_key, cursor_data['c'])):
+        raise ValueError("Invalid cursor")
+    return cursor_data['c']
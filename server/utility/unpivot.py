@@ -0,0 +1,95 @@
+import re
+
+try:
+    import numpy
+except ImportError:  # optional dependency, only needed for "long" layout exports
+    numpy = None
+
+LAYOUTS = ('wide', 'long')
+
+# "<measure><hhmm>[_b]" half-hour fields, hhmm is the end of the interval and 0000 the end of the day
+__SLOT_FIELD = re.compile(r'^(.+?)([01]\d|2[0-3])(00|30)(_b)?$')
+
+
+def available():
+    return numpy is not None
+
+
+def layout_error(layout, fields=None):
+    if layout not in LAYOUTS:
+        return f"invalid 'layout', expected one of: {', '.join(LAYOUTS)}"
+    if layout == 'long':
+        if not available():
+            return "'long' layout is not available on this server"
+        if fields is not None and 'date' not in fields:
+            return "'long' layout needs the 'date' field"
+    return None
+
+
+def slot_field(name):
+    # (measure, minutes after the start of the day the interval ends at) or None
+    match = __SLOT_FIELD.match(name)
+    if match is None:
+        return None
+    measure, hours, minutes, suffix = match.groups()
+    return measure + (suffix or ''), (int(hours) * 60 + int(minutes)) or 24 * 60
+
+
+class Unpivot:
+    # Turns wide rows (one per meter and day, one field per half hour) into one row per meter and half hour:
+    # the other fields are repeated, "date" becomes interval_start/interval_end, one column per measure
+    def __init__(self, header, date_field='date'):
+        self.date_index = header.index(date_field)
+        self.id_indexes = []
+        self.measures = []
+        slot_fields = {}  # (measure, end minutes) -> index in header
+        for index, name in enumerate(header):
+            slot = slot_field(name)
+            if slot is None:
+                if index != self.date_index:
+                    self.id_indexes.append(index)
+                continue
+            measure, minutes = slot
+            if measure not in self.measures:
+                self.measures.append(measure)
+            slot_fields[measure, minutes] = index
+
+        self.slot_minutes = sorted({minutes for _, minutes in slot_fields})
+        self.slots = len(self.slot_minutes)
+        self.header = [
+            *(header[index] for index in self.id_indexes),
+            'interval_start', 'interval_end',
+            *self.measures,
+        ]
+        # per measure: positions among the slots and the header indexes they are read from
+        self.measure_fields = []
+        for measure in self.measures:
+            positions, indexes = [], []
+            for position, minutes in enumerate(self.slot_minutes):
+                if (measure, minutes) in slot_fields:
+                    positions.append(position)
+                    indexes.append(slot_fields[measure, minutes])
+            self.measure_fields.append((positions, indexes))
+
+    def __call__(self, rows):
+        # rows: wide rows ordered like header, returns the long rows, whole arrays at a time
+        rows = list(rows)
+        if not rows or not self.slots:
+            return []
+        table = numpy.empty((len(rows), len(rows[0])), dtype=object)
+        table[:] = rows
+
+        ends = (
+            table[:, self.date_index].astype('datetime64[D]').astype('datetime64[m]')[:, None]
+            + numpy.array(self.slot_minutes, dtype='timedelta64[m]')[None, :]
+        ).reshape(-1)
+        starts = ends - numpy.timedelta64(30, 'm')
+
+        columns = [column.tolist() for column in numpy.repeat(table[:, self.id_indexes], self.slots, axis=0).T]
+        columns.append(starts.tolist())
+        columns.append(ends.tolist())
+        for positions, indexes in self.measure_fields:
+            values = numpy.full((len(rows), self.slots), None, dtype=object)
+            values[:, positions] = table[:, indexes]
+            columns.append(values.reshape(-1).tolist())
+        return list(zip(*columns))
@@ -1,10 +1,60 @@
-import datetime
+import asyncio
+import ipaddress
+import logging
 
 from aiohttp import web
 
+from server.utility import cache, config, database, request_log
 
-async def get_remote_username(local_db, username, api_key):
-    async with local_db.acquire() as conn:
+logger = logging.getLogger(__name__)
+
+# (username, api-key) -> remote_name, None for wrong keys
+API_KEY_CACHE_SIZE = 4096
+API_KEY_CACHE_TTL = 300
+API_KEY_NEGATIVE_TTL = 30
+# NOTIFY channel of the api_keys trigger, payload is the changed api_keys.name
+API_KEYS_CHANNEL = 'api_keys_changed'
+# client addresses (or networks) reading /metrics and /status/* without api-key headers
+METRICS_ALLOW = ()
+
+__API_KEY_CACHE = 'API_KEY_CACHE'
+__MISSING = object()
+
+
+async def api_key_cache_ctx(app: web.Application):
+    app[__API_KEY_CACHE] = cache.TTLCache(
+        maxsize=int(config(app, 'API_KEY_CACHE_SIZE', API_KEY_CACHE_SIZE)),
+        ttl=float(config(app, 'API_KEY_CACHE_TTL', API_KEY_CACHE_TTL)),
+    )
+    listener = asyncio.ensure_future(listen_api_keys(app))
+    yield  # <!> Do not remove this yield
+    listener.cancel()
+    try:
+        await listener
+    except asyncio.CancelledError:
+        pass
+
+
+def invalidate_api_keys(app: web.Application, username=None):
+    api_key_cache = app[__API_KEY_CACHE]
+    api_key_cache.invalidate()
+    if not username:
+        api_key_cache.clear()
+        return
+    for key in api_key_cache.keys():
+        if key[0] == username:
+            api_key_cache.pop(key)
+
+
+async def listen_api_keys(app: web.Application):
+    # Keys are dropped from the cache as soon as the api_keys trigger notifies about them
+    await database.listen(
+        config(app, 'LOCAL_STORAGE_DSN'), API_KEYS_CHANNEL, lambda username: invalidate_api_keys(app, username)
+    )
+
+
+async def select_remote_username(app: web.Application, username, api_key):
+    async with database.local_storage(app) as conn:
         async with conn.cursor() as cursor:
             select_username = """
                 SELECT keys.remote_name
@@ -16,14 +66,33 @@ async def get_remote_username(local_db, username, api_key):
                 AND 
                   keys.key = %(key)s
             """
-            await cursor.execute(select_username, {
-                "name": str(username),
-                "key": str(api_key)
+            await database.execute(cursor, select_username, {
+                "name": username,
+                "key": api_key
             })
             async for remote_name, in cursor:
                 return remote_name
+    return None
+
+
+async def get_remote_username(app: web.Application, username, api_key):
+    key = (str(username), str(api_key))
+    api_key_cache = app[__API_KEY_CACHE]
 
+    remote_name = api_key_cache.get(key, __MISSING)
+    if remote_name is __MISSING:
+        generation = api_key_cache.generation
+        remote_name = await select_remote_username(app, *key)
+        # not cached when the keys changed during the query: it may have read them before the change
+        if api_key_cache.generation == generation:
+            if remote_name is None:
+                api_key_cache.set(key, None, ttl=float(config(app, 'API_KEY_NEGATIVE_TTL', API_KEY_NEGATIVE_TTL)))
+            else:
+                api_key_cache.set(key, remote_name)
+
+    if remote_name is None:
         raise PermissionError("Wrong 'username' or 'api-key'")
+    return remote_name
 
 
 def access_headers(async_handler):
@@ -35,7 +104,7 @@ def access_headers(async_handler):
 
         try:
             request["username"] = await get_remote_username(
-                local_db=request.app['local_db'],
+                request.app,
                 username=str(request.headers["username"]),
                 api_key=str(request.headers["api-key"])
             )
@@ -49,20 +118,26 @@ def access_headers(async_handler):
     return async_wrapper
 
 
+def monitoring_access(async_handler):
+    checked_headers = access_headers(async_handler)
+
+    async def async_wrapper(request):
+        # request.remote is the peer: behind a proxy it is the proxy's address
+        allowed = config(request.app, 'METRICS_ALLOW', METRICS_ALLOW)
+        if request.remote and allowed:
+            try:
+                remote = ipaddress.ip_address(request.remote)
+            except ValueError:
+                remote = None
+            if remote is not None and any(remote in ipaddress.ip_network(network, strict=False) for network in allowed):
+                return await async_handler(request)
+        return await checked_headers(request)
+    return async_wrapper
+
+
 def access_logging(async_handler):
     async def async_wrapper(request):
-        async with request.app["local_db"].acquire() as conn:
-            async with conn.cursor() as cursor:
-                response = await async_handler(request)
-
-                request_log = """
-                     INSERT INTO request_log (datetime, name) 
-                         VALUES (%(datetime)s, %(name)s)
-                 """
-                await cursor.execute(request_log, {
-                    "datetime": datetime.datetime.now(),
-                    "name": request.headers["username"]
-                })
-
-                return response
+        response = await async_handler(request)
+        request_log.writer(request.app).log(request.headers["username"])
+        return response
     return async_wrapper